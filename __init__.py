@@ -1,3 +1,15 @@
-from .models import SFMClassifier, SFMRegressor
+from .inference import SFMScorer, EntityScorer, TopKRetriever
+from .selection import fit_many
+from .export import load_model
 
-__all__ = ['SFMClassifier', 'SFMRegressor']
+__all__ = ['SFMScorer', 'EntityScorer', 'TopKRetriever', 'fit_many', 'load_model']
+
+# the estimators need TensorFlow, scoring exported weights does not
+try:
+    from .models import SFMClassifier, SFMRegressor
+    from .optimizers import LazyAdamOptimizer
+except ImportError as e:
+    if 'tensorflow' not in str(e):
+        raise
+else:
+    __all__ += ['SFMClassifier', 'SFMRegressor', 'LazyAdamOptimizer']
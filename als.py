@@ -0,0 +1,348 @@
+"""
+    Alternating least squares training of Structural Factorization Machines with MSE loss
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+from tqdm import tqdm
+
+from .profiling import PhaseTimer
+
+
+def _with_columns(X, n_columns):
+    """X with exactly n_columns columns (appended columns are zero)."""
+    if X.shape[1] == n_columns:
+        return X
+    if sp.issparse(X):
+        return sp.csr_matrix((X.data, X.indices, X.indptr), shape=(X.shape[0], n_columns))
+    return np.hstack((X, np.zeros((X.shape[0], n_columns - X.shape[1]))))
+
+
+class ModeDesign(object):
+    """Feature matrix X of the samples of one mode, as rows of a matrix.
+
+    In the relational case X = matrix[rows] is never expanded: products
+    with X are computed on the entities (rows of the mode matrix) and the
+    sums over the samples of each entity are accumulated with bincount,
+    so the memory stays that of the mode matrix.
+
+    Parameters
+    ----------
+    matrix : {np.array, scipy.sparse.csr_matrix} of float64, shape (n_rows, n_features)
+
+    rows : np.array of int or None
+        Row of matrix of each sample, None if the samples are the rows
+        of matrix.
+    """
+    def __init__(self, matrix, rows=None):
+        self.matrix = matrix
+        self.rows = rows
+        if sp.issparse(matrix):
+            self.squared = matrix.multiply(matrix).tocsr()
+        else:
+            self.squared = matrix * matrix
+
+    def dot(self, W):
+        """X W"""
+        product = np.asarray(self.matrix.dot(W))
+        return product if self.rows is None else product[self.rows]
+
+    def _entity_sums(self, v):
+        if self.rows is None:
+            return v
+        return np.bincount(self.rows, weights=v, minlength=self.matrix.shape[0])
+
+    def rdot(self, v):
+        """X^T v"""
+        return np.asarray(self.matrix.T.dot(self._entity_sums(v))).ravel()
+
+    def squared_rdot(self, v):
+        """(X * X)^T v, the elementwise square of X."""
+        return np.asarray(self.squared.T.dot(self._entity_sums(v))).ravel()
+
+
+def design_matrices(X_, n_feature_list, input_type, mode_matrices=None, hashers=None):
+    """Feature matrix of the samples of each mode, see ModeDesign.
+
+    Mode matrices are kept at the entity level, 'index' inputs are turned
+    into one-hot (or weighted bag) CSR matrices and hashed modes are
+    hashed.
+
+    Returns
+    -------
+    design : list of ModeDesign, shape: [n_modes]
+    """
+    design = [None] * len(X_)
+    for m, X_in_mode in enumerate(X_):
+        hasher = None if hashers is None else hashers[m]
+        rows = None
+        if mode_matrices is not None:
+            X = mode_matrices[m]
+            if hasher is not None:
+                X = hasher.transform(X)
+            rows = np.asarray(X_in_mode, dtype=np.int64).ravel()
+        elif input_type == 'index':
+            if isinstance(X_in_mode, tuple):
+                ids, weights = [np.asarray(x) for x in X_in_mode]
+            else:
+                ids = np.asarray(X_in_mode)[:, np.newaxis]
+                weights = np.ones(ids.shape)
+            n_samples, bag_size = ids.shape
+            X = sp.csr_matrix((weights.ravel(), ids.ravel(), np.arange(0, ids.size + 1, bag_size)),
+                              shape=(n_samples, n_feature_list[m]))
+        elif hasher is not None:
+            X = hasher.transform(X_in_mode)
+        else:
+            X = X_in_mode
+        if sp.issparse(X):
+            X = sp.csr_matrix(X, dtype=np.float64)
+            X.sum_duplicates()
+        else:
+            X = np.asarray(X, dtype=np.float64)
+        design[m] = ModeDesign(_with_columns(X, n_feature_list[m]), rows)
+    return design
+
+
+def _ridge_update(X, q, e, w, lam, n_iter):
+    """Minimize ||e - q * (X d)||^2 + lam ||w + d||^2 over the update d of w.
+
+    X is a ModeDesign. Conjugate gradient with a Jacobi preconditioner
+    started from d = 0, so that the objective never increases; exact after
+    one iteration if the columns of X have disjoint supports (e.g. one-hot
+    features).
+
+    Returns
+    -------
+    d : np.array, update of w
+    Xd : np.array, X d
+    """
+    q2 = q * q
+    diagonal = X.squared_rdot(q2) + lam
+    diagonal[diagonal == 0] = 1.0
+
+    d = np.zeros_like(w)
+    Xd = np.zeros_like(e)
+    residual = X.rdot(q * e) - lam * w
+    z = residual / diagonal
+    p = z
+    rz = residual.dot(z)
+    for it in range(n_iter):
+        if rz <= 1e-20:
+            break
+        Xp = X.dot(p)
+        Ap = X.rdot(q2 * Xp) + lam * p
+        alpha = rz / p.dot(Ap)
+        d += alpha * p
+        Xd += alpha * Xp
+        residual -= alpha * Ap
+        z = residual / diagonal
+        rz_next = residual.dot(z)
+        p = z + (rz_next / rz) * p
+        rz = rz_next
+    return d, Xd
+
+
+class ALSState(object):
+    """Parameters, cached mode embeddings and residuals of an ALS fit.
+
+    Parameters
+    ----------
+    view_list: list of int tuple
+        # index starting from 1
+        modes in each view structure, see SFMCore.
+
+    design : list of ModeDesign, shape: [n_modes]
+        Feature matrices of the samples, see design_matrices().
+
+    y : np.array, shape (n_samples,)
+
+    params : dict
+        Initial 'W', 'Bias', 'Phi' as returned by SFMBaseModel.export_weights(),
+        updated in place (as float64 arrays).
+
+    reg : float
+        Strength of the L2 regularization, as in SFMCore: the target is
+        mean((y - outputs)^2) + reg * sum of the halved squared norms of the
+        factor tables, Bias and Phi.
+
+    isFullOrder : bool
+        Whether Bias is learned (otherwise it stays at zero).
+
+    cg_iter : int, default: 10
+        Conjugate gradient iterations per column solve.
+    """
+    def __init__(self, view_list, design, y, params, reg, isFullOrder, cg_iter=10):
+        self.view_list = [tuple(sorted(set(modes))) for modes in view_list]
+        self.design = design
+        self.y = np.asarray(y, dtype=np.float64)
+        self.n_samples = len(self.y)
+        self.W = [[None if W is None else np.array(W, dtype=np.float64) for W in tables]
+                  for tables in params['W']]
+        self.Bias = [[None if B is None else np.array(B, dtype=np.float64) for B in biases]
+                     for biases in params['Bias']]
+        self.Phi = np.array(params['Phi'], dtype=np.float64)
+        self.reg = reg
+        # the target multiplied by n_samples has ridge penalty lam / 2 * ||theta||^2 * 2
+        self.lam = self.n_samples * reg / 2
+        self.isFullOrder = isFullOrder
+        self.cg_iter = cg_iter
+        self.co_rank = self.W[0][0].shape[1]
+        self.view_rank = self.Phi.shape[0] - self.co_rank
+        self.n_modes = len(design)
+
+        # E[v][m] = [X_m W[0][m], X_m W[v][m]] + Bias[v][m]
+        XW0 = [np.asarray(X.dot(W)).reshape(self.n_samples, -1) for X, W in zip(design, self.W[0])]
+        self.E = {}
+        for i, modes in enumerate(self.view_list):
+            v = i + 1
+            for m in modes:
+                XW = XW0[m - 1]
+                if self.view_rank > 0:
+                    XW = np.hstack((XW, np.asarray(design[m - 1].dot(self.W[v][m - 1]))))
+                self.E[v, m] = XW + self.Bias[v][m - 1]
+        self.update_residuals()
+
+    def _view_product(self, v, exclude=None):
+        prod = np.ones((self.n_samples, self.Phi.shape[0]))
+        for m in self.view_list[v - 1]:
+            if m != exclude:
+                prod = prod * self.E[v, m]
+        return prod
+
+    def update_residuals(self):
+        outputs = 0
+        for i in range(len(self.view_list)):
+            outputs = outputs + self._view_product(i + 1).dot(self.Phi[:, i])
+        self.e = self.y - outputs
+
+    def target(self):
+        """mean((y - outputs)^2) + reg * regularization, as SFMCore.target."""
+        penalty = sum((W ** 2).sum() for tables in self.W for W in tables if W is not None)
+        penalty += sum((B ** 2).sum() for biases in self.Bias[1:] for B in biases if B is not None)
+        penalty += (self.Phi ** 2).sum()
+        return (self.e ** 2).mean() + self.reg * penalty / 2
+
+    def _solve_column(self, W, f, X, q, columns):
+        """Ridge update of W[:, f], with outputs q * (X W[:, f]) + ..., in the E[v, m][:, col]."""
+        d, Xd = _ridge_update(X, q, self.e, W[:, f], self.lam, self.cg_iter)
+        W[:, f] += d
+        self.e -= q * Xd
+        for key, col in columns:
+            self.E[key][:, col] += Xd
+
+    def _solve_bias(self, v, m, col, q):
+        B = self.Bias[v][m - 1]
+        curvature = q.dot(q) + self.lam
+        if curvature == 0:
+            # the target does not depend on this bias
+            return
+        delta = (q.dot(self.e) - self.lam * B[0, col]) / curvature
+        B[0, col] += delta
+        self.e -= q * delta
+        self.E[v, m][:, col] += delta
+
+    def sweep_mode(self, m):
+        """Update the factor tables and biases of mode m (from 1), the others fixed."""
+        views = [i + 1 for i, modes in enumerate(self.view_list) if m in modes]
+        X = self.design[m - 1]
+        if not views:
+            # no data term, the penalty alone is minimized at zero
+            for tables in self.W:
+                if tables[m - 1] is not None:
+                    tables[m - 1][:] = 0
+            return
+        # the products of the other modes do not depend on the tables of m
+        others = dict((v, self._view_product(v, exclude=m) * self.Phi[:, v - 1]) for v in views)
+        for f in range(self.co_rank):
+            q = sum(others[v][:, f] for v in views)
+            self._solve_column(self.W[0][m - 1], f, X, q, [((v, m), f) for v in views])
+        for v in views:
+            for f in range(self.view_rank):
+                col = self.co_rank + f
+                self._solve_column(self.W[v][m - 1], f, X, others[v][:, col], [((v, m), col)])
+        if self.isFullOrder:
+            for v in views:
+                for col in range(self.Phi.shape[0]):
+                    self._solve_bias(v, m, col, others[v][:, col])
+
+    def solve_phi(self):
+        """Exact ridge solution for Phi, the factor tables and biases fixed.
+
+        Least squares on the normal equations, which are singular for
+        reg=0 and linearly dependent view products.
+        """
+        r, n_views = self.Phi.shape
+        D = np.hstack([self._view_product(i + 1) for i in range(n_views)])
+        gram = D.T.dot(D) + self.lam * np.eye(r * n_views)
+        phi = np.linalg.lstsq(gram, D.T.dot(self.y), rcond=None)[0]
+        self.Phi = phi.reshape(n_views, r).T.copy()
+        self.e = self.y - D.dot(phi)
+
+    def sweep(self):
+        """One pass over all the modes and Phi. Returns the target value."""
+        for m in range(1, self.n_modes + 1):
+            self.sweep_mode(m)
+        self.solve_phi()
+        return self.target()
+
+
+def _load_params(model, state):
+    """Load the solution of state into the variables of model.core."""
+    core = model.core
+    for v, tables in enumerate(core.W):
+        for m, var in enumerate(tables):
+            if var is None:
+                continue
+            # keep the spare rows of the tables, see feature_headroom
+            value = np.zeros((core.capacity_list[m], state.W[v][m].shape[1]), dtype=np.float32)
+            value[:state.W[v][m].shape[0]] = state.W[v][m]
+            var.load(value, model.session)
+    for v, biases in enumerate(core.Bias):
+        for m, var in enumerate(biases):
+            if var is not None:
+                var.load(state.Bias[v][m].astype(np.float32), model.session)
+    core.Phi.load(state.Phi.astype(np.float32), model.session)
+
+
+def fit_als(model, X_, y_, mode_matrices=None, n_epochs=None, show_progress=False, tol=1e-5, cg_iter=10):
+    """Fit an SFMRegressor by alternating least squares, see SFMRegressor.
+
+    Each sweep solves the columns of the factor tables of one mode after
+    the other, then the biases and Phi, each a ridge regression given the
+    rest. The sweeps stop when the relative decrease of the target is below
+    tol. model.fit_timing records the phases 'prepare' and 'sweep'.
+
+    Returns
+    -------
+    used_epoch : int
+        Index of the last sweep run.
+    """
+    if model.core.reg_type != 'L2':
+        raise ValueError('The ALS solver only supports reg_type=\'L2\'')
+    model.fit_timing = PhaseTimer()
+    model._prepare_core(X_, mode_matrices)
+    if n_epochs is None:
+        n_epochs = model.n_epochs
+    model.entity_scorer = None
+    with model.fit_timing.phase('prepare'):
+        design = design_matrices(X_, model.core.n_feature_list, model.core.input_type,
+                                 mode_matrices, model.hashers)
+        state = ALSState(model.core.view_list, design, model.preprocess_target(y_),
+                         model.export_weights(), model.core.reg, model.core.isFullOrder, cg_iter)
+
+    previous_target_value = state.target()
+    used_epoch = 0
+    for epoch in tqdm(range(n_epochs), unit='epoch', disable=(not show_progress)):
+        with model.fit_timing.phase('sweep'):
+            target_value = state.sweep()
+        used_epoch = epoch
+        model.steps += 1
+        if model.verbose > 1:
+            print(target_value)
+        # the target is 0 for a perfect fit without regularization
+        if previous_target_value - target_value <= tol * max(previous_target_value, np.finfo(np.float64).tiny):
+            break
+        previous_target_value = target_value
+    _load_params(model, state)
+    return used_epoch
@@ -2,18 +2,37 @@ from __future__ import (absolute_import, division,
                                 print_function, unicode_literals)
 import tensorflow as tf
 from .core import SFMCore
+from .inference import SFMScorer, TopKRetriever
+from .export import save_model
+from .data import (PreparedDataset, prepare_mode_matrices, load_shard, make_hashers,
+                   n_index_features, reg_scales)
+from .profiling import PhaseTimer
+from .parallel import fit_parallel
 from sklearn.base import BaseEstimator
+from sklearn.exceptions import NotFittedError
 from abc import ABCMeta, abstractmethod
 import six
 from tqdm import tqdm
 import numpy as np
 import os
+import time
+from tensorflow.python.client import timeline
 
 
 def sigmoid(x):
     return 1 / (1 + np.exp(-x))
 
 
+def truncated_normal(shape, stddev):
+    """Normal values redrawn beyond two standard deviations, as tf.truncated_normal."""
+    values = np.random.randn(*shape)
+    outside = np.abs(values) > 2
+    while outside.any():
+        values[outside] = np.random.randn(outside.sum())
+        outside = np.abs(values) > 2
+    return (values * stddev).astype(np.float32)
+
+
 # Predefined loss functions
 # Should take 2 tf.Ops: outputs and targets and should return tf.Op of loss
 # Be carefull about dimentionality -- maybe tf.transpose(outputs) is needed
@@ -29,101 +48,6 @@ def loss_mse(outputs, y):
 #    return tf.pow(y -  outputs, 2, name='mse_loss')
 
 
-def batcher(X_, y_=None,  batch_size=-1):
-    """Split data to mini-batches.
-
-    Parameters
-    ----------
-    X_ : {numpy.array, scipy.sparse.csr_matrix}, shape (n_samples, n_features)
-        Training vector, where n_samples in the number of samples and
-        n_features is the number of features.
-
-    y_ : np.array or None, shape (n_samples,)
-        Target vector relative to X.
-
-    perm: the permuation of the instances
-
-    batch_size : int
-        Size of batches.
-        Use -1 for full-size batches
-
-    Yields
-    -------
-    ret_x : {numpy.array, scipy.sparse.csr_matrix}, shape (batch_size, n_features)
-        Same type as input
-    ret_y : np.array or None, shape (batch_size,)
-    """
-    assert isinstance(X_, list)
-
-    n_modes = len(X_)
-    n_samples = X_[0].shape[0]
-    if batch_size == -1:
-        batch_size = n_samples
-    if batch_size < 1:
-       raise ValueError('Parameter batch_size={} is unsupported'.format(batch_size))
-
-    for i in range(0, n_samples, batch_size):
-        upper_bound = min(i + batch_size, n_samples)
-        ret_x = [None] * n_modes
-        for m in range(n_modes):
-            ret_x[m] = X_[m][i:upper_bound]
-        ret_y = None
-        if y_ is not None:
-            ret_y = y_[i:upper_bound]
-        yield (ret_x, ret_y)
-
-
-def batch_to_feeddict(X, y, core, mode_matrices = None):
-    """Prepare feed dict for session.run() from mini-batch.
-    Convert sparse format into tuple (indices, values, shape) for tf.SparseTensor
-    Parameters
-    ----------
-    X : {numpy.array, scipy.sparse.csr_matrix}, shape (batch_size, n_features)
-        Training vector, where batch_size in the number of samples and
-        n_features is the number of features.
-    y : np.array, shape (batch_size,)
-        Target vector relative to X.
-    core : SFMCore
-        Core used for extract appropriate placeholders 
-    Returns
-    -------
-    fd : dict
-        Dict with formatted placeholders
-    """
-    fd = {}
-    if core.isRelational and mode_matrices is not None:
-        # each instance is the tuple of indicator of the mode matrix
-        n_modes = len(mode_matrices)
-        for m in range(n_modes):
-            fd[core.train_x[m]] = X[m].astype(np.int64)
-            if core.input_type == 'dense':
-                fd[core.mode_matrices[m]] = mode_matrices[m].astype(np.float32)
-            else:
-                X_sparse = mode_matrices[m].tocoo()
-                fd[core.raw_indices[m]] = np.hstack(
-                    (X_sparse.row[:, np.newaxis], X_sparse.col[:, np.newaxis])
-                ).astype(np.int64)
-                fd[core.raw_values[m]] = X_sparse.data.astype(np.float32)
-                fd[core.raw_shape[m]] = np.array(X_sparse.shape).astype(np.int64)
-    else:
-        assert isinstance(X,list)
-        n_modes = len(X)
-        if core.input_type == 'dense':
-            for m in range(n_modes):
-                fd[core.train_x[m]] = X[m].astype(np.float32)
-        else:
-            # sparse case
-            for m in range(n_modes):
-                X_sparse = X[m].tocoo()
-                fd[core.raw_indices[m]] = np.hstack(
-                    (X_sparse.row[:, np.newaxis], X_sparse.col[:, np.newaxis])
-                ).astype(np.int64)
-                fd[core.raw_values[m]] = X_sparse.data.astype(np.float32)
-                fd[core.raw_shape[m]] = np.array(X_sparse.shape).astype(np.int64)
-    if y is not None:
-        fd[core.train_y] = y.astype(np.float32)
-    return fd
-
 class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
     """Base class for Structural Factorization Machines.
 
@@ -155,13 +79,57 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
     reg : float, default: 0
         Strength of regularization
 
+    lazy_reg : bool, default: False
+        'sparse' and 'index' input only (not relational). Penalize only the
+        rows of the factor tables used by each batch, scaled by the inverse
+        frequency of their features in the training data, so that the
+        per-step cost of the regularization scales with the batch nonzeros.
+        The penalty over the full tables stays available for reporting, see
+        full_regularization(). Ignored for other inputs. LazyAdamOptimizer
+        only updates the factor tables lazily with lazy_reg=True or reg=0.
+
     optimizer : tf.train.Optimizer, default: AdamOptimizer(learning_rate=0.1)
         Optimization method used for training
+        LazyAdamOptimizer only updates the rows of the factor tables used by
+        each batch with 'sparse', 'index' and relational sparse input, see
+        SFMCore.
 
     batch_size : int, default: -1
         Number of samples in mini-batches. Shuffled every epoch.
         Use -1 for full gradient (whole training set in each batch).
 
+    resident_data : bool, default: False
+        With batch_size=-1, upload the training set into the graph once per
+        fit() (see SFMCore.set_resident_inputs) and run every epoch without
+        feeding it, instead of copying it into the session on every step.
+        Costs a second copy of the training set held by TensorFlow.
+
+    predict_batch_size : int, default: 10000
+        Number of samples scored at once by decision_function() and predict(),
+        independently of batch_size. Use -1 to score the whole input at once.
+
+    shuffle : {'index', 'block', None}, default: 'index'
+        How mini-batches are shuffled every epoch. 'index' permutes an
+        index array and gathers the rows of each batch on demand, 'block'
+        only shuffles the order of contiguous batches (zero-copy, but the
+        composition of the batches is fixed). None disables shuffling.
+        The input data is never copied as a whole.
+
+    prefetch : int, default: 0
+        Number of mini-batches prepared in advance on background threads
+        while the current one is processed by the session.
+        Use 0 for strictly serial batch preparation.
+
+    prefetch_threads : int, default: 1
+        Number of threads preparing the mini-batches when prefetch > 0.
+
+    feature_headroom : float, default: 0.0
+        Fraction of spare rows allocated in the factor tables of each mode
+        when the graph is built, and again whenever they have to be
+        reallocated. While the tables have spare rows, inputs with new
+        features (see partial_fit()) grow them in place; otherwise the
+        graph and the session are rebuilt, keeping the learned values.
+
     n_epoch : int, default: 100
         Default number of epoches.
         It can be overrived by explicitly provided value in fit() method.
@@ -171,10 +139,26 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
         The factor augment in tf.contrib.layers.variance_scaling_initializer()
         http://www.tensorflow.org/api_docs/python/contrib.layers/initializers#variance_scaling_initializer
 
-    input_type : str, 'dense' or 'sparse', default: 'dense'
+    input_type : str, 'dense', 'sparse' or 'index', default: 'dense'
         Type of input data. Only numpy.array allowed for 'dense' and
         scipy.sparse.csr_matrix for 'sparse'. This affects construction of
         computational graph and cannot be changed during training/testing.
+        'index' is meant for categorical modes: each mode is given as an
+        int array of one feature id per sample, or as a bag (ids, weights)
+        of 2-D arrays of shape (n_samples, bag_size) padded with zero
+        weights. Embeddings are looked up by id instead of multiplying
+        one-hot matrices, and the number of features of a mode is its
+        largest id plus one. Not supported with mode matrices.
+
+    hash_buckets : int, list of {int, None}, or None, default: None
+        Sparse input only. Hash the column indices of the inputs (or of the
+        mode matrices in the relational case) of every mode, or of each
+        mode with an int in the list, into hash_buckets columns. Inputs can
+        then use raw feature ids as column indices, and the factor tables
+        have hash_buckets rows whatever the number of distinct ids.
+
+    hash_sign : bool, default: False
+        Multiply the hashed values by a +1/-1 sign hash, see FeatureHasher.
 
     log_dir : str or None, default: None
         Path for storing model stats during training. Used only if is not None.
@@ -182,6 +166,22 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
         You can use TensorBoard to visualize the stats:
         `tensorboard --logdir={log_dir}`
 
+    summary_steps : int, default: 100
+        Summaries are computed every summary_steps training steps and
+        written asynchronously. They are never computed if log_dir is None.
+
+    step_callback : function: (int, dict) -> None, or None, default: None
+        Called after every training step with the step number and a dict
+        holding 'epoch', 'batch_size', 'target', and the seconds spent in
+        each phase of fit_timing ('shuffle', 'batch', 'wait', 'session_run',
+        'summary', ...) since the previous step, this step included.
+        Phases run on prefetching threads are accounted when they finish.
+
+    trace_steps : iterable of int or None, default: None
+        Training steps run with a full TensorFlow trace. The tf.RunMetadata
+        are kept in .traces and, if log_dir is set, exported to TensorBoard
+        and to Chrome trace files log_dir/timeline_step{step}.json.
+
     session_config : tf.ConfigProto or None, default: None
         Additional setting passed to tf.Session object.
         Useful for CPU/GPU switching.
@@ -209,6 +209,25 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
     steps : int
         Counter of passed lerning epochs, used as step number for writing stats
 
+    best_validation_loss : float
+        Best loss on the validation set seen by the last call of fit(),
+        np.inf if no validation set was given.
+
+    fit_timing, predict_timing : PhaseTimer
+        Wall time of the last fit() and decision_function() calls, by phase:
+        'prepare' (conversion of the inputs), 'shuffle' (batch order),
+        'batch' (slicing/gathering into feed dicts, on prefetching threads
+        if enabled), 'wait' (time spent waiting for the next feed dict,
+        including 'batch' without prefetching), 'session_run', 'summary'
+        and 'evaluate' (validation). See PhaseTimer.report().
+
+    traces : dict, step -> tf.RunMetadata
+        Traces of the steps listed in trace_steps.
+
+    entity_scorer : EntityScorer or None
+        Cached per-entity embeddings used for relational prediction,
+        set by freeze().
+
     n_feature_list : int
         Number of features in each mode used in this dataset.
         Inferred during the first call of fit() method.
@@ -236,9 +255,14 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
     """
 
     def init_basemodel(self, co_rank=10, view_rank=0, isFullOrder=True, view_list=None, input_type='dense', output_range = None,
-                        n_epochs=100, loss_function=None, batch_size=-1, reg_type='L2', reg=0.01, init_std=0.01, init_scaling=2.0,
+                        n_epochs=100, loss_function=None, batch_size=-1, resident_data=False,
+                        predict_batch_size=10000,
+                        shuffle='index', prefetch=0, prefetch_threads=1, feature_headroom=0.0,
+                        hash_buckets=None, hash_sign=False,
+                        reg_type='L2', reg=0.01, lazy_reg=False, init_std=0.01, init_scaling=2.0,
                         optimizer=tf.train.AdamOptimizer(learning_rate=0.01),
-                        log_dir=None, session_config=None, verbose=0):
+                        log_dir=None, summary_steps=100, step_callback=None, trace_steps=None,
+                        session_config=None, verbose=0):
         assert view_list is not None
         self.core_arguments = {
             'co_rank': co_rank,
@@ -251,18 +275,37 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
             'optimizer': optimizer,
             'reg_type': reg_type,
             'reg': reg,
+            'lazy_reg': lazy_reg,
             'init_std': init_std,
             'init_scaling': init_scaling
         }
         self.output_range = output_range
         self.core = SFMCore(**self.core_arguments)
         self.batch_size = batch_size
+        self.resident_data = resident_data
+        self.predict_batch_size = predict_batch_size
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.prefetch_threads = prefetch_threads
+        self.feature_headroom = feature_headroom
+        if hash_buckets is not None and input_type != 'sparse':
+            raise ValueError('Feature hashing requires input_type=\'sparse\'')
+        self.hash_buckets = hash_buckets
+        self.hash_sign = hash_sign
+        self.hashers = make_hashers(hash_buckets, self.core.n_modes, hash_sign)
         self.n_epochs = n_epochs
         self.need_logs = log_dir is not None
         self.log_dir = log_dir
+        self.summary_steps = summary_steps
         self.session_config = session_config
         self.verbose = verbose
         self.steps = 0
+        self.step_callback = step_callback
+        self.trace_steps = set(trace_steps or [])
+        self.traces = {}
+        self.fit_timing = PhaseTimer()
+        self.predict_timing = PhaseTimer()
+        self.entity_scorer = None
 
 
     def set_core_params(self, params):
@@ -279,9 +322,11 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
         if self.core.graph is None:
             raise 'Graph not found. Try call .core.build_graph() before ._initialize_session()'
         if self.need_logs:
+            # events are queued and written by the background thread of the writer
             self.summary_writer = tf.summary.FileWriter(
                 self.log_dir,
-                self.core.graph)
+                self.core.graph,
+                flush_secs=30)
             if self.verbose > 0:
                 print('Initialize logs, use: \ntensorboard --logdir={}'.format(
                     os.path.abspath(self.log_dir)))
@@ -291,99 +336,494 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
         self.session = tf.Session(config= cf,
                 graph=self.core.graph)
         self.session.run(self.core.init_all_vars)
+        self.loaded_mode_matrices = None
+        self.resident_dataset = None
 
     @abstractmethod
     def preprocess_target(self, target):
         """Prepare target values to use."""
 
-    def fit(self, X_, y_, mode_matrices=None, n_epochs=None, early_stop = None, show_progress=False):
-        # TODO: check this
+    def _prepare_core(self, X_, mode_matrices=None):
+        """Infer n_feature_list from the inputs and build the graph if needed."""
         assert isinstance(X_,list)
 
         n_feature_list = [None]* len(X_)
-        n_instance = X_[0].shape[0]
 
         if mode_matrices is not None:
             assert isinstance(mode_matrices, list)
+            if self.core.input_type == 'index':
+                raise ValueError('Mode matrices are not supported with input_type=\'index\'')
             self.core.set_relational_input(True)
             for m, mode_matrix in enumerate(mode_matrices):
                 n_feature_list[m] = mode_matrix.shape[1]
+        elif self.core.input_type == 'index':
+            for m, X_in_mode in enumerate(X_):
+                n_feature_list[m] = n_index_features(X_in_mode)
         else:
             for m, X_in_mode in enumerate(X_):
                 n_feature_list[m] = X_in_mode.shape[1]
-
-        self.core.set_num_features(n_feature_list)
-        assert isinstance(self.core.n_feature_list, list)
+        if self.hashers is not None:
+            for m, hasher in enumerate(self.hashers):
+                if hasher is not None:
+                    n_feature_list[m] = hasher.n_buckets
 
         if self.core.graph is None:
+            if self.core.input_type == 'index':
+                self.core.set_bag_modes([isinstance(X_in_mode, tuple) for X_in_mode in X_])
+            self.core.set_num_features(n_feature_list)
+            self.core.set_capacity([self._capacity(n) for n in n_feature_list])
+            self.core.set_resident_inputs(self.resident_data and self.batch_size == -1)
             self.core.build_graph()
             self._initialize_session()
+        elif self.core.inference_only:
+            raise ValueError('The graph was built for inference only and cannot be fitted')
+        else:
+            self.grow_features(n_feature_list)
+        if mode_matrices is not None:
+            self.load_mode_matrices(mode_matrices)
+        # the weights are about to change, see freeze()
+        self.entity_scorer = None
+
+    def _capacity(self, n_features):
+        return int(np.ceil(n_features * (1 + self.feature_headroom)))
+
+    def grow_features(self, n_feature_list):
+        """Extend the factor tables of each mode to n_feature_list features.
+
+        The rows of the known features are kept and the rows of the new ones
+        are initialized as at the beginning of training. Tables with enough
+        spare rows are grown in place; otherwise the graph and the session
+        are rebuilt with larger tables and the values of all the variables,
+        optimizer state included, are copied over.
+        """
+        old_list = self.core.n_feature_list
+        new_list = [max(old, new) for old, new in zip(old_list, n_feature_list)]
+        if new_list == old_list:
+            return
+        if any(n > capacity for n, capacity in zip(new_list, self.core.capacity_list)):
+            self._rebuild([max(capacity, self._capacity(n))
+                           for n, capacity in zip(new_list, self.core.capacity_list)])
+        for m, (old, new) in enumerate(zip(old_list, new_list)):
+            if new == old:
+                continue
+            stddev = np.sqrt(1.3 * self.core.init_scaling / new)
+            for v in range(self.core.n_views + 1):
+                if self.core.W[v][m] is None:
+                    continue
+                rows, values, update = self.core.row_updates[v][m]
+                self.session.run(update, feed_dict={
+                    rows: np.arange(old, new),
+                    values: truncated_normal((new - old, values.get_shape().as_list()[1]), stddev)})
+        self.core.set_num_features(new_list)
+        self.entity_scorer = None
+
+    def _rebuild(self, capacity_list):
+        """Rebuild the graph with capacity_list rows in the factor tables, keeping all values."""
+        variables = self.core.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        values = dict(zip([var.op.name for var in variables], self.session.run(variables)))
+        mode_matrices = self.loaded_mode_matrices
+        self.session.close()
+        if self.need_logs:
+            self.summary_writer.close()
+
+        self.core.set_capacity(capacity_list)
+        self.core.build_graph()
+        self._initialize_session()
+        for var in self.core.graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES):
+            value = values.get(var.op.name)
+            if value is None:
+                continue
+            if value.shape != tuple(var.get_shape().as_list()):
+                # larger table: the spare rows keep their initial zeros
+                table = self.session.run(var)
+                table[:value.shape[0]] = value
+                value = table
+            var.load(value, self.session)
+        if mode_matrices is not None:
+            self.load_mode_matrices(mode_matrices)
+        self.entity_scorer = None
 
-        used_y = self.preprocess_target(y_)
+    def load_mode_matrices(self, mode_matrices):
+        """Load the mode matrices of the relational case into the graph.
 
+        They stay resident in the session until other mode matrices are
+        loaded, so the same list is converted and transferred only once.
+        """
+        if self.loaded_mode_matrices is not None and \
+                len(self.loaded_mode_matrices) == len(mode_matrices) and \
+                all(a is b for a, b in zip(self.loaded_mode_matrices, mode_matrices)):
+            return
+        fd = {}
+        prepared = prepare_mode_matrices(mode_matrices, self.core.input_type, self.hashers)
+        for m in range(len(mode_matrices)):
+            for placeholder, value in zip(self.core.mode_matrix_inputs[m], prepared[m]):
+                fd[placeholder] = value
+        self.session.run(self.core.init_mode_matrices, feed_dict=fd)
+        self.loaded_mode_matrices = list(mode_matrices)
+
+    def preprocess_shard_target(self, target):
+        """Prepare target values of one shard of fit_files(), see preprocess_target().
+
+        Unlike a whole training set, a shard may lack some of the classes.
+        """
+        return self.preprocess_target(target)
+
+    def _prepare_dataset(self, X_, y_, shard=False):
+        y_ = self.preprocess_shard_target(y_) if shard else self.preprocess_target(y_)
+        dataset = PreparedDataset(X_, y_,
+                                  input_type=self.core.input_type,
+                                  batch_size=self.batch_size,
+                                  isRelational=self.core.isRelational,
+                                  shuffle=self.shuffle,
+                                  hashers=self.hashers)
+        self.set_reg_scales(dataset)
+        if self.core.init_resident_inputs is not None:
+            self.upload_dataset(dataset)
+        return dataset
+
+    def upload_dataset(self, dataset):
+        """Load a dataset as a single batch into the resident inputs of the graph, see resident_data."""
+        fd = dataset.feeddict(self.core, slice(0, dataset.n_samples))
+        self.session.run(self.core.init_resident_inputs,
+                         feed_dict=dict((self.core.resident_uploads[x], value) for x, value in fd.items()))
+        self.resident_dataset = dataset
+
+    def set_reg_scales(self, dataset):
+        """Load the feature frequencies of dataset used by lazy_reg.
+
+        The penalty of a row is scaled by the number of samples fed per
+        epoch / frequency of its feature among them, see reg_scales().
+        """
+        if self.core.init_reg_scales is None:
+            return
+        self.reg_scale_values = []
+        fd = {}
+        for m, placeholder in enumerate(self.core.reg_scale_inputs):
+            counts = dataset.feature_counts(m, self.core.capacity_list[m])
+            self.reg_scale_values.append(reg_scales(counts, dataset.epoch_size))
+            fd[placeholder] = self.reg_scale_values[m]
+        self.session.run(self.core.init_reg_scales, feed_dict=fd)
+
+    def full_regularization(self):
+        """Penalty over the full factor tables, Bias and Phi (without the reg factor)."""
+        if self.core.graph is None:
+            raise NotFittedError("Call fit before computing the regularization")
+        return self.session.run(self.core.full_regularization)
+
+    def _snapshot(self):
+        """Copy the values of the learnable parameters into memory."""
+        variables = self.core.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+        return list(zip(variables, self.session.run(variables)))
+
+    def _restore(self, snapshot):
+        """Load values copied by _snapshot() back into the session."""
+        for var, value in snapshot:
+            var.load(value, self.session)
+
+    def _evaluate(self, dataset):
+        """Mean loss over a PreparedDataset (regularization excluded)."""
+        loss_value = 0.0
+        for fd in dataset.feeddicts(self.core, self.prefetch, self.prefetch_threads, self.fit_timing):
+            loss_value += self.session.run(self.core.reduced_loss, feed_dict=fd) * len(fd[self.core.train_y])
+        return loss_value / dataset.n_samples
+
+    def _record_trace(self, step, run_metadata):
+        """Keep the tf.RunMetadata of a traced step and export it to log_dir."""
+        self.traces[step] = run_metadata
+        if self.need_logs:
+            self.summary_writer.add_run_metadata(run_metadata, 'step{}'.format(step), step)
+            trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+            with open(os.path.join(self.log_dir, 'timeline_step{}.json'.format(step)), 'w') as f:
+                f.write(trace)
+
+    def _train(self, epoch_datasets, n_epochs=None, early_stop=None, show_progress=False,
+               validation=None, eval_every=1, patience=5):
+        """Training cycle.
+
+        Parameters
+        ----------
+        epoch_datasets : function: () -> iterable of PreparedDataset
+            Called at the beginning of every epoch, returns the datasets
+            to pass through during this epoch.
+
+        validation : PreparedDataset or None
+            Held-out data for early stopping, see fit().
+        """
         if n_epochs is None:
             n_epochs = self.n_epochs
-        
+        self.entity_scorer = None
+
+        best_weights = None
+        self.best_validation_loss = np.inf
+        bad_evaluations = 0
         previous_target_value = np.inf
         used_epoch = 0
         previous_core = self.core
         # Training cycle
         if self.verbose > 1:
             print('target value')
+        timer = self.fit_timing
+        last_totals = timer.snapshot()
         for epoch in tqdm(range(n_epochs), unit='epoch', disable=(not show_progress)):
-
-            # generate permutation
-            perm = np.random.permutation(n_instance)
-            n_modes = len(X_)
-            X_tmp = [None for i in range(n_modes)]
-            for m in range(n_modes):
-                X_tmp[m] = X_[m][perm]
-            y_tmp = used_y[perm]
             target_value = 0
             cc = 0
             # iterate over batches
-            for bX, bY in batcher(X_tmp, y_tmp, batch_size=self.batch_size):
-                if self.core.isRelational:
-                    fd = batch_to_feeddict(bX, bY, core=self.core, mode_matrices=mode_matrices)
+            for dataset in epoch_datasets():
+                if dataset is self.resident_dataset:
+                    # the whole dataset is resident in the graph, nothing to feed
+                    batches = [{}]
                 else:
-                    fd = batch_to_feeddict(bX, bY, core=self.core)
-                ops_to_run = [self.core.trainer, self.core.target,  self.core.summary_op]
-                result = self.session.run(ops_to_run, feed_dict=fd)
-#                self.session.run(self.core.post_step)
-                _, batch_target_value,  summary_str = result
-
-                target_value += batch_target_value
-
-                # Write stats
-                if self.need_logs:
-                    self.summary_writer.add_summary(summary_str, self.steps)
-                    self.summary_writer.flush()
-                self.steps += 1
-                cc += 1
+                    batches = dataset.feeddicts(self.core, self.prefetch, self.prefetch_threads, timer)
+                for fd in timer.iterate('wait', batches):
+                    ops_to_run = [self.core.trainer, self.core.target]
+                    write_summary = self.need_logs and self.steps % self.summary_steps == 0
+                    if write_summary:
+                        ops_to_run.append(self.core.summary_op)
+                    run_options, run_metadata = None, None
+                    if self.steps in self.trace_steps:
+                        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                        run_metadata = tf.RunMetadata()
+                    start = time.time()
+                    result = self.session.run(ops_to_run, feed_dict=fd,
+                                              options=run_options, run_metadata=run_metadata)
+                    run_time = time.time() - start
+                    timer.add('session_run', run_time)
+#                    self.session.run(self.core.post_step)
+                    batch_target_value = result[1]
+
+                    target_value += batch_target_value
+
+                    # Write stats, the writer flushes them from its own thread
+                    if write_summary:
+                        with timer.phase('summary'):
+                            self.summary_writer.add_summary(result[2], self.steps)
+                    if run_metadata is not None:
+                        self._record_trace(self.steps, run_metadata)
+                    if self.step_callback is not None:
+                        totals = timer.snapshot()
+                        info = dict((name, total - last_totals.get(name, 0.0))
+                                    for name, total in totals.items())
+                        last_totals = totals
+                        info.update({
+                            'epoch': epoch,
+                            'batch_size': len(fd[self.core.train_y]) if fd else dataset.n_samples,
+                            'target': batch_target_value,
+                            'session_run': run_time})
+                        self.step_callback(self.steps, info)
+                    self.steps += 1
+                    cc += 1
             if self.verbose > 1:
                 print(target_value/cc)
             # warm up iterations: 100
             used_epoch = epoch
             if early_stop and epoch >= early_stop and (previous_target_value - target_value) / previous_target_value <= 1e-5:
-                self.save_state('tmp/core')
                 break
             previous_target_value = target_value
 
+            if validation is not None and (epoch + 1) % eval_every == 0:
+                with timer.phase('evaluate'):
+                    validation_loss = self._evaluate(validation)
+                if self.verbose > 1:
+                    print('validation loss: {}'.format(validation_loss))
+                if validation_loss < self.best_validation_loss:
+                    self.best_validation_loss = validation_loss
+                    best_weights = self._snapshot()
+                    bad_evaluations = 0
+                else:
+                    bad_evaluations += 1
+                    if bad_evaluations >= patience:
+                        break
+
+        if best_weights is not None:
+            self._restore(best_weights)
+        if self.need_logs:
+            self.summary_writer.flush()
         return used_epoch
 
+    def _prepare_validation(self, X_val, y_val):
+        if X_val is None:
+            return None
+        return PreparedDataset(X_val, self.preprocess_target(y_val),
+                               input_type=self.core.input_type,
+                               batch_size=self.predict_batch_size,
+                               isRelational=self.core.isRelational,
+                               hashers=self.hashers)
+
+    def fit(self, X_, y_, mode_matrices=None, n_epochs=None, early_stop = None, show_progress=False,
+            X_val=None, y_val=None, eval_every=1, patience=5):
+        """Fit the model.
+
+        Parameters
+        ----------
+        X_ : list of {numpy.array, scipy.sparse.csr_matrix}, shape: [n_modes]
+            Samples of each mode, or the row indicators of mode_matrices
+            in the relational case.
+
+        y_ : np.array, shape (n_samples,)
+
+        mode_matrices : list of {numpy.array, scipy.sparse.csr_matrix} or None
+            Mode matrices used in the relational case.
+
+        n_epochs : int or None
+            Overrides the n_epochs given at initialization.
+
+        early_stop : int or None
+            Stop when the relative decrease of the training target is below
+            1e-5, after early_stop epochs of warm up.
+
+        X_val, y_val : held-out data or None
+            Same format as X_ and y_ (row indicators of the same mode_matrices
+            in the relational case). The validation loss is evaluated every
+            eval_every epochs and training stops after patience evaluations
+            without improvement. The best weights are kept in memory and
+            restored at the end of training.
+
+        Returns
+        -------
+        used_epoch : int
+            Index of the last epoch run.
+        """
+        # TODO: check this
+        self.fit_timing = PhaseTimer()
+        self._prepare_core(X_, mode_matrices)
+        with self.fit_timing.phase('prepare'):
+            dataset = self._prepare_dataset(X_, y_)
+
+        return self._train(lambda: [dataset], n_epochs, early_stop, show_progress,
+                           self._prepare_validation(X_val, y_val), eval_every, patience)
+
+    def partial_fit(self, X_, y_, mode_matrices=None, n_epochs=1, show_progress=False):
+        """Continue training on new data, starting from the current weights.
+
+        Inputs may have more features (or mode matrices more columns) in
+        any mode than the data seen so far: the factor tables are grown
+        (see grow_features()), with the new features appended after the
+        known ones in the same column order.
+
+        Parameters
+        ----------
+        n_epochs : int, default: 1
+            Number of passes over X_.
+
+        See fit() for the other parameters.
+
+        Returns
+        -------
+        used_epoch : int
+            Index of the last epoch run.
+        """
+        self.fit_timing = PhaseTimer()
+        self._prepare_core(X_, mode_matrices)
+        with self.fit_timing.phase('prepare'):
+            dataset = self._prepare_dataset(X_, y_)
+        return self._train(lambda: [dataset], n_epochs, show_progress=show_progress)
+
+    def fit_files(self, mode_files, target_files, mode_matrices=None, n_epochs=None,
+                  early_stop=None, show_progress=False, shuffle_shards=True,
+                  X_val=None, y_val=None, eval_every=1, patience=5):
+        """Fit the model on data stored on disk, one shard at a time.
+
+        Only one shard is held in memory at a time; within a shard the
+        mini-batches are built and shuffled as in fit(). Shards may hold
+        more features than the previous ones (appended after the known
+        ones), the factor tables are then grown as in partial_fit(), and
+        a shard may hold a single class.
+
+        Parameters
+        ----------
+        mode_files : list of list of str, shape: [n_shards][n_modes]
+            Files of each mode in each shard: '.npy' files are memory-mapped
+            (dense input or row indicators of the mode matrices) and '.npz'
+            files are read with scipy.sparse.load_npz (sparse input).
+
+        target_files : list of str, shape: [n_shards]
+            '.npy' files with the target vector of each shard.
+
+        mode_matrices : list of {numpy.array, scipy.sparse.csr_matrix} or None
+            Mode matrices used in the relational case, kept in memory.
+
+        shuffle_shards : bool, default: True
+            Visit the shards in a random order every epoch. The first epoch
+            still starts with the first shard, loaded to build the graph.
+
+        See fit() for the other parameters.
+        """
+        assert len(mode_files) == len(target_files)
+        self.fit_timing = PhaseTimer()
+        # the shard loaded to build the graph opens the first epoch
+        loaded = {0: load_shard(mode_files[0])}
+        self._prepare_core(loaded[0], mode_matrices)
+
+        def epoch_datasets():
+            order = list(range(len(mode_files)))
+            if shuffle_shards:
+                order = list(np.random.permutation(len(mode_files)))
+            if loaded:
+                order.remove(0)
+                order.insert(0, 0)
+            for i in order:
+                X_shard = loaded.pop(i) if i in loaded else load_shard(mode_files[i])
+                # a shard may hold more features than the previous ones, see grow_features()
+                self._prepare_core(X_shard, mode_matrices)
+                with self.fit_timing.phase('prepare'):
+                    dataset = self._prepare_dataset(X_shard, np.load(target_files[i], mmap_mode='r'),
+                                                    shard=True)
+                yield dataset
+
+        return self._train(epoch_datasets, n_epochs, early_stop, show_progress,
+                           self._prepare_validation(X_val, y_val), eval_every, patience)
+
+    def fit_parallel(self, X_, y_, mode_matrices=None, n_workers=2, sync_period=None,
+                     n_epochs=None, show_progress=False):
+        """Data-parallel training on n_workers CPU threads.
+
+        The samples are split into n_workers shards, each worker shuffles and
+        runs the mini-batches of its own shard. TensorFlow releases the GIL
+        during session.run, so the workers run concurrently on the cores.
+
+        Parameters
+        ----------
+        n_workers : int, default: 2
+            Number of workers.
+
+        sync_period : int or None, default: None
+            None for asynchronous Hogwild-style training: all the workers
+            update the shared variables of the model session without locks.
+            Otherwise every worker trains its own replica (graph and session)
+            of the model, and the replicas' W, Bias, Phi and b are averaged
+            every sync_period steps of each worker.
+
+        See fit() for the other parameters. Validation, summaries and step
+        callbacks are not supported in this mode.
+
+        Returns
+        -------
+        used_epoch : int
+            Index of the last epoch run.
+        """
+        return fit_parallel(self, X_, y_, mode_matrices, n_workers, sync_period,
+                            n_epochs, show_progress)
 
     def decision_function(self, X, mode_matrices=None):
         if self.core.graph is None:
-            raise sklearn.exceptions.NotFittedError("Call fit before prediction")
+            raise NotFittedError("Call fit before prediction")
+        if self.core.isRelational and mode_matrices is None and self.entity_scorer is not None:
+            return self.entity_scorer.decision_function(X, batch_size=self.predict_batch_size)
         output = []
         assert (self.core.isRelational and mode_matrices is not None) or \
                 (not self.core.isRelational and mode_matrices is None)
-        for bX, bY in batcher(X, y_=None, batch_size=self.batch_size):
-            if self.core.isRelational:
-                fd = batch_to_feeddict(bX, bY, core=self.core, mode_matrices=mode_matrices)
-            else:
-                fd = batch_to_feeddict(bX, bY, core=self.core)
-            output.append(self.session.run(self.core.outputs, feed_dict=fd))
+        timer = self.predict_timing = PhaseTimer()
+        if mode_matrices is not None:
+            self.load_mode_matrices(mode_matrices)
+        with timer.phase('prepare'):
+            dataset = PreparedDataset(X, input_type=self.core.input_type,
+                                      batch_size=self.predict_batch_size,
+                                      isRelational=self.core.isRelational,
+                                      hashers=self.hashers)
+        batches = dataset.feeddicts(self.core, self.prefetch, self.prefetch_threads, timer)
+        for fd in timer.iterate('wait', batches):
+            with timer.phase('session_run'):
+                output.append(self.session.run(self.core.outputs, feed_dict=fd))
         pred_y= np.concatenate(output).reshape(-1)
         # TODO: check this reshape
         return pred_y
@@ -402,14 +842,143 @@ class SFMBaseModel(six.with_metaclass(ABCMeta, BaseEstimator)):
         """Export underlying weights from tf.Variables to np.arrays."""
         return [x.eval(session=self.session) for x in self.core.w]
 
+    def export_weights(self):
+        """Export learned parameters from tf.Variables to np.arrays.
+
+        Returns
+        -------
+        params : dict
+            'W' and 'Bias' are nested lists of shape [n_views + 1][n_modes]
+            holding None where the parameter does not exist (see SFMCore),
+            'Phi' has shape [co_rank + view_rank, n_views] and 'b' is a float.
+        """
+        if self.core.graph is None:
+            raise NotFittedError("Call fit before exporting weights")
+        fetches = {'Phi': self.core.Phi, 'b': self.core.b}
+        for name in ['W', 'Bias']:
+            for v, variables in enumerate(getattr(self.core, name)):
+                for m, var in enumerate(variables):
+                    if var is not None:
+                        fetches[(name, v, m)] = var
+        values = self.session.run(fetches)
+        params = {'Phi': values['Phi'], 'b': float(values['b'])}
+        for name in ['W', 'Bias']:
+            params[name] = [[values.get((name, v, m)) for m in range(self.core.n_modes)]
+                                for v in range(self.core.n_views + 1)]
+        # spare rows of the factor tables, see feature_headroom
+        params['W'] = [[None if W is None else W[:n_features]
+                        for W, n_features in zip(tables, self.core.n_feature_list)]
+                       for tables in params['W']]
+        return params
+
+    def scorer(self):
+        """Snapshot of the current weights as a TensorFlow-free SFMScorer."""
+        return SFMScorer(view_list=self.core.view_list,
+                         input_type=self.core.input_type,
+                         hashers=self.hashers,
+                         **self.export_weights())
+
+    def freeze(self, mode_matrices):
+        """Cache the projected embeddings of every entity for relational prediction.
+
+        Afterwards decision_function(X) (with mode_matrices=None) scores the
+        tuples of entity indices X by gathers from the cache only. The cache
+        is dropped whenever the weights change: fit(), partial_fit() and the
+        other fitting methods, or load_state().
+
+        Returns
+        -------
+        entity_scorer : EntityScorer
+        """
+        assert self.core.isRelational
+        self.entity_scorer = self.scorer().freeze(mode_matrices)
+        return self.entity_scorer
+
+    def retriever(self, target_mode, mode_matrices=None, views=None, n_clusters=None, n_probe=8):
+        """Top-k retrieval index over the entities of target_mode.
+
+        Parameters
+        ----------
+        target_mode : int
+            # index starting from 1
+
+        mode_matrices : list or None
+            Mode matrices of the relational case, or None to use the
+            entities cached by freeze(). For non-relational models None
+            treats every mode as one-hot encoded: entities are the features
+            of the mode.
+
+        See TopKRetriever for the other parameters.
+
+        Returns
+        -------
+        retriever : TopKRetriever
+        """
+        if mode_matrices is None and self.entity_scorer is not None:
+            entity_scorer = self.entity_scorer
+        elif mode_matrices is None and self.core.isRelational:
+            raise ValueError('Relational models need mode_matrices or a frozen entity scorer, see freeze()')
+        else:
+            entity_scorer = self.scorer().freeze(mode_matrices)
+        return TopKRetriever(entity_scorer, target_mode, views=views,
+                             n_clusters=n_clusters, n_probe=n_probe)
+
+    def export(self, path, dtype='float32'):
+        """Export the weights and settings into a single memory-mappable file.
+
+        Unlike save_state(), the file is loaded without TensorFlow, by
+        export.load_model(), as an SFMScorer.
+
+        Parameters
+        ----------
+        path : str
+
+        dtype : str, 'float32', 'float16' or 'int8', default: 'float32'
+            Storage type of the factor tables, int8 with per-column scales.
+        """
+        config = dict((name, self.core_arguments[name])
+                      for name in ['co_rank', 'view_rank', 'isFullOrder', 'input_type',
+                                   'output_range', 'reg_type', 'reg'])
+        config['estimator'] = type(self).__name__
+        config['isRelational'] = self.core.isRelational
+        config['n_feature_list'] = [int(n) for n in self.core.n_feature_list]
+        config['hash_buckets'] = self.hash_buckets
+        config['hash_sign'] = self.hash_sign
+        save_model(path, self.export_weights(), self.core.view_list, dtype=dtype, config=config)
+
     def save_state(self, path):
         self.core.saver.save(self.session, path)
 
-    def load_state(self, path):
+    def load_state(self, path, n_feature_list=None, inference_only=False, bag_modes=None):
+        """Restore the weights saved by save_state().
+
+        Parameters
+        ----------
+        path : str
+
+        n_feature_list : list of int or None
+            Number of features in each mode if the graph is not built yet.
+            Defaults to the number of rows of the saved factor tables.
+
+        inference_only : bool, default: False
+            If the graph is not built yet, build only its output path
+            (see SFMCore.build_graph). The model can then predict but not be fitted.
+
+        bag_modes : list of bool or None
+            'index' input only, the modes fed with bags of ids if the graph
+            is not built yet, see SFMCore.set_bag_modes().
+        """
         if self.core.graph is None:
-            self.core.build_graph()
+            shapes = tf.train.NewCheckpointReader(path).get_variable_to_shape_map()
+            capacity_list = [shapes['co_mode_{}/embedding_init'.format(m + 1)][0]
+                             for m in range(self.core.n_modes)]
+            self.core.set_num_features(n_feature_list or capacity_list)
+            self.core.set_capacity(capacity_list)
+            self.core.set_bag_modes(bag_modes)
+            self.core.build_graph(inference_only=inference_only)
             self._initialize_session()
         self.core.saver.restore(self.session, path)
+        self.entity_scorer = None
 
     def destroy(self):
         """Terminate session and destroyes graph."""
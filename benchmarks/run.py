@@ -0,0 +1,212 @@
+"""
+    Throughput benchmarks of SFMRegressor/SFMClassifier on synthetic data.
+
+Every configuration runs in its own process so that the reported peak RSS
+belongs to it only. Results are printed (or appended to --output) as one
+JSON object per line, e.g.
+
+    python -m SFM.benchmarks.run --n-samples 20000 --output results.jsonl
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import argparse
+import itertools
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .synthetic import make_multiview
+
+
+class StepTimer(object):
+    """Proxy of a tf.Session recording the duration of every run() call."""
+    def __init__(self, session):
+        self.session = session
+        self.durations = []
+
+    def run(self, *args, **kwargs):
+        start = time.time()
+        result = self.session.run(*args, **kwargs)
+        self.durations.append(time.time() - start)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2.0 ** 20 if sys.platform == 'darwin' else rss / 2.0 ** 10
+
+
+def _percentiles_ms(durations):
+    if len(durations) == 0:
+        return {}
+    values = np.percentile(np.array(durations) * 1000.0, [50, 90, 99])
+    return {'p50': float(values[0]), 'p90': float(values[1]), 'p99': float(values[2])}
+
+
+def check_scorers(model, X, mode_matrices):
+    """Check that the NumPy scorer and the exported model match the graph outputs.
+
+    Returns
+    -------
+    max_abs_diff : dict
+        Largest difference to model.predict() of model.scorer() ('scorer')
+        and of export.load_model() on a float32 export ('export').
+    """
+    from ..export import load_model
+
+    predictions = model.decision_function(X, mode_matrices)
+    outputs = {'scorer': model.scorer().decision_function(X, mode_matrices)}
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'model.sfmx')
+        model.export(path)
+        outputs['export'] = load_model(path, mmap=False).decision_function(X, mode_matrices)
+    finally:
+        shutil.rmtree(directory)
+    max_abs_diff = {}
+    for name, values in outputs.items():
+        max_abs_diff[name] = float(np.abs(values - predictions).max())
+        if not np.allclose(values, predictions, rtol=1e-4, atol=1e-5):
+            raise AssertionError('{} outputs differ from predict() by up to {}'.format(
+                name, max_abs_diff[name]))
+    return max_abs_diff
+
+
+def run_config(config):
+    """Fit and predict once for a single configuration.
+
+    Returns
+    -------
+    result : dict
+        The configuration with the measured throughputs, latencies and peak RSS.
+    """
+    from ..models import SFMClassifier, SFMRegressor
+
+    # relational configurations use sparse mode matrices
+    relational = config['input'] == 'relational'
+    input_type = 'dense' if config['input'] == 'dense' else 'sparse'
+    task = 'classification' if config['model'] == 'classifier' else 'regression'
+    X, y, mode_matrices = make_multiview(
+        n_samples=config['n_samples'], view_list=config['view_list'],
+        n_features=config['n_features'], density=config['density'], input_type=input_type,
+        relational=relational, n_entities=config['n_entities'], task=task,
+        random_state=config['seed'])
+
+    estimator = SFMClassifier if config['model'] == 'classifier' else SFMRegressor
+    # hashing applies to sparse columns only
+    hash_buckets = config.get('hash_buckets') if input_type == 'sparse' else None
+    model = estimator(co_rank=config['co_rank'], view_rank=config['view_rank'],
+                      view_list=config['view_list'], input_type=input_type,
+                      batch_size=config['batch_size'], predict_batch_size=config['predict_batch_size'],
+                      hash_buckets=hash_buckets)
+
+    # the first epoch includes graph construction and session start
+    start = time.time()
+    model.fit(X, y, mode_matrices=mode_matrices, n_epochs=1)
+    warmup = time.time() - start
+
+    timer = StepTimer(model.session)
+    model.session = timer
+    start = time.time()
+    model.fit(X, y, mode_matrices=mode_matrices, n_epochs=config['n_epochs'])
+    fit_time = time.time() - start
+    steps = timer.durations
+    timer.durations = []
+
+    start = time.time()
+    model.decision_function(X, mode_matrices=mode_matrices)
+    predict_time = time.time() - start
+    fit_phases = model.fit_timing.report()
+    predict_phases = model.predict_timing.report()
+    model.session = timer.session
+    max_abs_diff = check_scorers(model, X, mode_matrices)
+    model.destroy()
+
+    result = dict(config)
+    result.update({
+        'input_type': input_type,
+        'warmup_sec': warmup,
+        'fit_samples_per_sec': config['n_samples'] * config['n_epochs'] / fit_time,
+        'fit_steps': len(steps),
+        'step_latency_ms': _percentiles_ms(steps),
+        'predict_samples_per_sec': config['n_samples'] / predict_time,
+        'predict_batch_latency_ms': _percentiles_ms(timer.durations),
+        'fit_phases': fit_phases,
+        'predict_phases': predict_phases,
+        'scorer_max_abs_diff': max_abs_diff,
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    return result
+
+
+def configurations(args):
+    view_list = [[int(m) for m in v.split(',')] for v in args.view_list.split(';')]
+    ranks = [tuple(int(r) for r in pair.split(':')) for pair in args.ranks.split(',')]
+    for model, input_format, (co_rank, view_rank), batch_size in itertools.product(
+            args.models.split(','), args.inputs.split(','), ranks,
+            [int(b) for b in args.batch_sizes.split(',')]):
+        yield {
+            'model': model, 'input': input_format, 'co_rank': co_rank, 'view_rank': view_rank,
+            'batch_size': batch_size, 'predict_batch_size': args.predict_batch_size,
+            'view_list': view_list, 'n_samples': args.n_samples, 'n_features': args.n_features,
+            'n_entities': args.n_entities, 'density': args.density, 'n_epochs': args.n_epochs,
+            'hash_buckets': args.hash_buckets, 'seed': args.seed,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1].strip())
+    parser.add_argument('--models', default='regressor,classifier')
+    parser.add_argument('--inputs', default='dense,sparse,relational')
+    parser.add_argument('--ranks', default='8:0,8:4', help='co_rank:view_rank pairs')
+    parser.add_argument('--batch-sizes', default='256,-1')
+    parser.add_argument('--predict-batch-size', type=int, default=10000)
+    parser.add_argument('--view-list', default='1,2;1,3', help='modes of each view, e.g. "1,2,3;1,2"')
+    parser.add_argument('--n-samples', type=int, default=10000)
+    parser.add_argument('--n-features', type=int, default=1000)
+    parser.add_argument('--n-entities', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=0.01)
+    parser.add_argument('--n-epochs', type=int, default=5)
+    parser.add_argument('--hash-buckets', type=int, default=None,
+                        help='hash the sparse columns of every mode into this many buckets')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='append JSON lines to this file')
+    parser.add_argument('--no-isolate', action='store_true',
+                        help='run every configuration in this process')
+    parser.add_argument('--single', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single is not None:
+        print(json.dumps(run_config(json.loads(args.single))))
+        return
+
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for config in configurations(args):
+            if args.no_isolate:
+                line = json.dumps(run_config(config))
+            else:
+                line = subprocess.check_output(
+                    [sys.executable, '-m', __package__ + '.run', '--single', json.dumps(config)],
+                    env=env).decode('utf-8').strip().split('\n')[-1]
+            out.write(line + '\n')
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
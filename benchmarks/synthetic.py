@@ -0,0 +1,97 @@
+"""
+    Synthetic multi-view datasets generated from a random Structural Factorization Machine
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+
+from ..inference import SFMScorer
+
+
+def _random_mode(n_rows, n_features, density, input_type, rng):
+    if input_type == 'dense':
+        X = rng.rand(n_rows, n_features).astype(np.float32)
+        if density < 1.0:
+            X *= rng.rand(n_rows, n_features) < density
+        return X
+    return sp.random(n_rows, n_features, density=density, format='csr',
+                     dtype=np.float32, random_state=rng)
+
+
+def make_multiview(n_samples=1000, view_list=((1, 2), (1, 3)), n_features=100,
+                   density=0.1, input_type='sparse', relational=False, n_entities=1000,
+                   rank=4, noise=0.1, task='regression', random_state=None):
+    """Generate a multi-view dataset with a known SFM structure.
+
+    Parameters
+    ----------
+    n_samples : int, default: 1000
+
+    view_list: list of int tuple
+        # index starting from 1
+        modes in each view structure, see SFMCore.
+
+    n_features : int or list of int, default: 100
+        Number of features in each mode.
+
+    density : float, default: 0.1
+        Fraction of non-zero features.
+
+    input_type : str, 'dense' or 'sparse', default: 'sparse'
+        Format of the generated mode data.
+
+    relational : bool, default: False
+        If True, generate mode matrices of n_entities rows and return the
+        row indicators of the samples in each mode instead of the features.
+
+    n_entities : int or list of int, default: 1000
+        Number of rows of each mode matrix in the relational case.
+
+    rank : int, default: 4
+        Rank of the generating model.
+
+    noise : float, default: 0.1
+        Standard deviation of the gaussian noise added to the outputs.
+
+    task : str, 'regression' or 'classification', default: 'regression'
+        Classification targets are the {0, 1} signs of the centered outputs.
+
+    random_state : int or None
+
+    Returns
+    -------
+    X : list of {numpy.array, scipy.sparse.csr_matrix}, shape: [n_modes]
+    y : np.array, shape (n_samples,)
+    mode_matrices : list or None
+        Mode matrices in the relational case, None otherwise.
+    """
+    rng = np.random.RandomState(random_state)
+    view_list = [tuple(v) for v in view_list]
+    n_modes = max([x for v in view_list for x in v])
+    n_views = len(view_list)
+    if np.isscalar(n_features):
+        n_features = [n_features] * n_modes
+    if np.isscalar(n_entities):
+        n_entities = [n_entities] * n_modes
+
+    W = [[rng.randn(n, rank) / np.sqrt(n * density) for n in n_features]]
+    W += [[None] * n_modes for i in range(n_views)]
+    Bias = [[None] * n_modes] + [[np.ones((1, rank)) if m + 1 in v else None
+                                  for m in range(n_modes)] for v in view_list]
+    scorer = SFMScorer(view_list, W, Bias, rng.randn(rank, n_views))
+
+    mode_matrices = None
+    if relational:
+        mode_matrices = [_random_mode(n_entities[m], n_features[m], density, input_type, rng)
+                         for m in range(n_modes)]
+        X = [rng.randint(0, n_entities[m], size=n_samples) for m in range(n_modes)]
+    else:
+        X = [_random_mode(n_samples, n_features[m], density, input_type, rng)
+             for m in range(n_modes)]
+
+    y = scorer.decision_function(X, mode_matrices, batch_size=10000)
+    y = y + noise * y.std() * rng.randn(n_samples)
+    if task == 'classification':
+        y = (y > np.median(y)).astype(int)
+    return X, y, mode_matrices
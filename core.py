@@ -5,6 +5,7 @@ from __future__ import (absolute_import, division,
                                 print_function, unicode_literals)
 import tensorflow as tf
 import math
+from collections import Counter
 
 
 class SFMCore():
@@ -29,13 +30,20 @@ class SFMCore():
         Number of view-discriminative factors in low-rank appoximation.
         Shared by all the modes.
 
-    input_type : str, 'dense' or 'sparse', default: 'dense'
+    input_type : str, 'dense', 'sparse' or 'index', default: 'dense'
         Type of input data. Only numpy.array allowed for 'dense' and
-        scipy.sparse.csr_matrix for 'sparse'. This affects construction of
+        scipy.sparse.csr_matrix for 'sparse'. 'index' takes the feature ids
+        of categorical modes, looked up in the factor tables by gathers
+        (see set_bag_modes). This affects construction of
         computational graph and cannot be changed during training/testing.
 
     optimizer : tf.train.Optimizer, default: AdamOptimizer(learning_rate=0.1)
-        Optimization method used for training
+        Optimization method used for training.
+        With 'sparse', 'index' and relational sparse input the gradients of
+        the factor tables are tf.IndexedSlices of the rows used by the batch;
+        optimizers with lazy sparse updates (LazyAdamOptimizer, Adagrad)
+        then only read and write these rows, as long as the regularization
+        does not add a dense gradient.
 
     reg_type: str
         'L1', 'L2', 'L21', 'maxNorm' are supported, default: 'L2'
@@ -43,6 +51,15 @@ class SFMCore():
     reg : float, default: 0
         Strength of regularization
 
+    lazy_reg : bool, default: False
+        'sparse' and 'index' input only (not relational). Penalize at each
+        step only the rows of the factor tables used by the batch, once per
+        occurrence, each scaled by n_samples / (batch_size * frequency of
+        the feature). This is an unbiased estimate of the full-table
+        penalty whose cost scales with the batch nonzeros instead of the
+        table sizes. The frequencies are loaded by running init_reg_scales
+        with reg_scale_inputs fed, see set_reg_scales in SFMBaseModel.
+
     init_scaling : float, default: 2.0
         Amplitude of random initialization
         The factor augment in tf.contrib.layers.variance_scaling_initializer()
@@ -53,13 +70,44 @@ class SFMCore():
     graph : tf.Graph or None
         Initialized computational graph or None
 
-    trainer : tf.Op
+    trainer : tf.Op or None
         TensorFlow operation node to perform learning on single batch
+        None for an inference-only graph.
+
+    outputs : tf.Tensor
+        Raw outputs of the model, shape [batch_size, 1]
 
     n_feature_list : list of int
         Number of features in each mode used in this dataset.
         Inferred during the first call of fit() method.
 
+    capacity_list : list of int
+        Number of rows of the factor tables of each mode, at least
+        n_feature_list. Rows beyond n_feature_list are zero and reserved for
+        features added later, see set_capacity().
+
+    row_updates : list of list of (tf.Tensor, tf.Tensor, tf.Op) or None, shape: [n_view + 1][n_mode]
+        For the factor tables with spare rows: placeholders of row indices
+        and values and the op writing these values into the table.
+
+    bag_modes : list of bool or None
+        'index' input only. Whether each mode takes a bag of weighted ids
+        per sample instead of a single id, see set_bag_modes().
+
+    train_weights : list of {tf.Tensor, None}, shape: [n_mode]
+        Weights of the ids of the bag modes, None for the other modes.
+
+    regularization : tf.Tensor
+        Penalty added to the loss in the target, see lazy_reg.
+
+    full_regularization : tf.Tensor
+        Penalty over the full tables, only evaluated on demand (reporting,
+        summaries) if lazy_reg is set.
+
+    resident_uploads : dict, tf.Tensor -> tf.Tensor
+        With set_resident_inputs(True): placeholder of the value loaded
+        into the resident copy of each data input, by init_resident_inputs.
+
     saver : tf.Op
         tf.train.Saver instance, connected to graph
 
@@ -74,6 +122,12 @@ class SFMCore():
         First element in each mode will have shape [n_feature_list[mode], co_rank]
         all the others -- [n_feature_list[mode], view_rank].
 
+    mode_matrices : list of list of tf.Variable, shape: [n_mode]
+        Relational case only. Non-trainable copies of the mode matrices
+        ([matrix] if dense, [indptr, indices, data] CSR arrays if sparse),
+        loaded once by running init_mode_matrices with mode_matrix_inputs fed.
+        They are not saved by saver.
+
     Notes
     -----
     
@@ -86,7 +140,7 @@ class SFMCore():
 
     """
     def __init__(self, view_list, co_rank, view_rank, isFullOrder, input_type, output_range,
-                    loss_function, optimizer, reg_type, reg, init_std, init_scaling):
+                    loss_function, optimizer, reg_type, reg, init_std, init_scaling, lazy_reg=False):
         self.view_list = view_list
         self.co_rank = co_rank
         self.view_rank = view_rank
@@ -96,14 +150,19 @@ class SFMCore():
         self.optimizer = optimizer
         self.reg_type = reg_type
         self.reg = reg
+        self.lazy_reg = lazy_reg
         self.init_std = init_std
         self.init_scaling = init_scaling
         self.n_modes = max([x for v in view_list for x in v ])
         self.n_views = len(view_list)
         self.n_feature_list = None
+        self.capacity_list = None
+        self.bag_modes = None
         self.mode_matrices = None
         self.graph = None
+        self.inference_only = False
         self.isRelational = False
+        self.resident = False
         self.isFullOrder = isFullOrder
 
     def set_relational_input(self, isRelational):
@@ -113,6 +172,59 @@ class SFMCore():
     def set_num_features(self, n_feature_list):
         self.n_feature_list = n_feature_list
 
+    def set_capacity(self, capacity_list):
+        """Allocate capacity_list[m] rows in the factor tables of mode m.
+
+        Must be set before building the graph, defaults to n_feature_list.
+        A mode with spare rows accepts inputs of any width up to its capacity:
+        its input placeholders have no static width and the tables are sliced
+        to the width of the input, so features can be added without
+        rebuilding the graph.
+        """
+        self.capacity_list = capacity_list
+
+    def set_resident_inputs(self, resident):
+        """Back the data inputs by variables holding a whole dataset.
+
+        Every data placeholder (train_x, train_weights, raw_*, train_y)
+        becomes a tf.placeholder_with_default over a non-trainable variable,
+        loaded once by running init_resident_inputs with resident_uploads
+        fed. Running the trainer without feeds then trains on the resident
+        data, while fed inputs (mini-batches, prediction) work as before.
+        Must be set before building the graph, ignored for inference-only
+        graphs.
+        """
+        assert isinstance(resident, bool)
+        self.resident = resident
+
+    def set_bag_modes(self, bag_modes):
+        """Select the 'index' modes fed with bags of ids.
+
+        A single-valued mode is fed a vector of ids, shape [batch_size], and
+        its embedding is the row of each id. A bag mode is fed ids and
+        weights of shape [batch_size, bag_size], padded with zero weights,
+        and its embedding is the weighted sum of the rows of the ids.
+        Must be set before building the graph, defaults to no bag mode.
+        """
+        self.bag_modes = bag_modes
+
+    def _table_initializer(self, m):
+        """Initializer of the factor tables of mode m (from 0).
+
+        The rows of the n_feature_list[m] features are drawn as by
+        variance_scaling_initializer, the spare rows start at zero.
+        """
+        initializer = tf.contrib.layers.variance_scaling_initializer(factor = self.init_scaling)
+        n_features, capacity = self.n_feature_list[m], self.capacity_list[m]
+        if capacity == n_features:
+            return initializer
+
+        def growable_initializer(shape, dtype=tf.float32, partition_info=None):
+            shape = list(shape)
+            return tf.concat(axis=0, values=[initializer([n_features] + shape[1:], dtype=dtype),
+                                             tf.zeros([capacity - n_features] + shape[1:], dtype=dtype)])
+        return growable_initializer
+
     def _init_learnable_params(self):
         self.W = [[None] * self.n_modes for i in range(self.n_views + 1)]
         self.Bias = [[None] * self.n_modes for i in range(self.n_views + 1)]
@@ -136,9 +248,9 @@ class SFMCore():
         for m in range(self.n_modes):
             with tf.variable_scope('co_mode_'+str(m+1)):
                 self.W[0][m] = tf.get_variable('embedding_init',
-                           shape = [self.n_feature_list[m], self.co_rank],
+                           shape = [self.capacity_list[m], self.co_rank],
                            trainable=True,
-                           initializer = tf.contrib.layers.variance_scaling_initializer(factor = self.init_scaling))
+                           initializer = self._table_initializer(m))
                 self.S[m] = tf.get_variable('layer_norm_S', initializer = tf.ones([r]))
 
         # initialize view specific facotrs for each mode
@@ -146,29 +258,30 @@ class SFMCore():
             v = i+1
             for m in set(modes):
                 with tf.variable_scope('view_'+str(v)+'_mode_' + str(m)):
-                    try:
-                        self.Bias[v][m-1] = tf.get_variable('bias', shape = [1,r],
-                                trainable = self.isFullOrder,
-                                initializer=tf.zeros_initializer())
-                    except:
-                        print('bias mode {} shared in view {}'.format(m,v))
-                    try:
-                        if self.view_rank>0:
-                            self.W[v][m-1] = tf.get_variable('embedding_init',
-                                shape = [self.n_feature_list[m-1], self.view_rank],
-                                trainable=True,
-                                initializer = tf.contrib.layers.variance_scaling_initializer(factor = init_scaling))
-                    except:
-                        print('mode {} shared in view {}'.format(m,v))
+                    self.Bias[v][m-1] = tf.get_variable('bias', shape = [1,r],
+                            trainable = self.isFullOrder,
+                            initializer=tf.zeros_initializer())
+                    if self.view_rank>0:
+                        self.W[v][m-1] = tf.get_variable('embedding_init',
+                            shape = [self.capacity_list[m-1], self.view_rank],
+                            trainable=True,
+                            initializer = self._table_initializer(m-1))
 
 
     def _init_placeholders(self):
         self.train_x = [None]*self.n_modes
+        self.resident_inputs = []
+        self.resident_uploads = {}
+        self.init_resident_inputs = None
         if self.isRelational:
+            # mode matrices are kept resident in non-trainable variables,
+            # loaded once through mode_matrix_inputs by init_mode_matrices
             self.mode_matrices = [None] * self.n_modes
+            self.mode_matrix_inputs = [None] * self.n_modes
 
+        self.train_weights = [None]*self.n_modes
         #sparse case
-        if self.input_type != 'dense':
+        if self.input_type == 'sparse' and not self.isRelational:
             self.raw_indices = [None]*self.n_modes
             self.raw_values = [None]*self.n_modes
             self.raw_shape = [None]*self.n_modes
@@ -176,24 +289,75 @@ class SFMCore():
         for i in range(self.n_modes):
             with tf.variable_scope('mode_'+str(i+1)):
                 # if given mode matrix, the input X_ is the list of the row indicators of the mode matrix
-                if self.input_type == 'dense':
-                    if self.isRelational:
-                        self.train_x[i] = tf.placeholder(tf.int64, shape=[None], name='X_indices')
-                        self.mode_matrices[i] = tf.placeholder(tf.float32, shape=[None, self.n_feature_list[i]], name='X_matrix')
+                if self.isRelational:
+                    self.train_x[i] = self._input(tf.int64, [None], 'X_indices')
+                    if self.input_type == 'dense':
+                        self.mode_matrix_inputs[i] = [
+                            tf.placeholder(tf.float32, shape=[None, self.input_width[i]], name='X_matrix')]
+                    else:
+                        # CSR arrays: row offsets, column indices and values
+                        self.mode_matrix_inputs[i] = [
+                            tf.placeholder(tf.int64, shape=[None], name='X_matrix_indptr'),
+                            tf.placeholder(tf.int64, shape=[None], name='X_matrix_indices'),
+                            tf.placeholder(tf.float32, shape=[None], name='X_matrix_data')]
+                    self.mode_matrices[i] = [
+                        tf.Variable(x, trainable=False, collections=[], validate_shape=False,
+                                    name=x.op.name.split('/')[-1] + '_resident')
+                        for x in self.mode_matrix_inputs[i]]
+                elif self.input_type == 'dense':
+                    self.train_x[i] = self._input(tf.float32, [None, self.input_width[i]], 'X')
+                elif self.input_type == 'index':
+                    if self.bag_modes is not None and self.bag_modes[i]:
+                        self.train_x[i] = self._input(tf.int64, [None, None], 'X_ids')
+                        self.train_weights[i] = self._input(tf.float32, [None, None], 'X_weights')
                     else:
-                        self.train_x[i] = tf.placeholder(tf.float32, shape=[None, self.n_feature_list[i]], name='X')
+                        self.train_x[i] = self._input(tf.int64, [None], 'X_ids')
                 else:
                     #sparse case
-                    self.raw_indices[i] = tf.placeholder(tf.int64, shape=[None, 2], name='raw_indices')
-                    self.raw_values[i] = tf.placeholder(tf.float32, shape=[None], name='raw_data')
-                    self.raw_shape[i] = tf.placeholder(tf.int64, shape=[2], name='raw_shape')
-                    if self.isRelational:
-                        self.train_x[i] = tf.placeholder(tf.int64, shape=[None], name='X_indices')
-                        self.mode_matrices[i] = tf.SparseTensor(self.raw_indices[i], self.raw_values[i], self.raw_shape[i])
+                    self.raw_indices[i] = self._input(tf.int64, [None, 2], 'raw_indices')
+                    self.raw_values[i] = self._input(tf.float32, [None], 'raw_data')
+                    self.raw_shape[i] = self._input(tf.int64, [2], 'raw_shape')
                     # tf.sparse_reorder is not needed since scipy return COO in canonical order
-                    else:
-                        self.train_x[i] = tf.SparseTensor(self.raw_indices[i], self.raw_values[i], self.raw_shape[i])
-        self.train_y = tf.placeholder(tf.float32, shape=[None], name='Y')
+                    self.train_x[i] = tf.SparseTensor(self.raw_indices[i], self.raw_values[i], self.raw_shape[i])
+        if self.isRelational:
+            self.init_mode_matrices = tf.variables_initializer(
+                [x for variables in self.mode_matrices for x in variables])
+        self.train_y = self._input(tf.float32, [None], 'Y')
+        if self.resident_uploads:
+            self.init_resident_inputs = tf.variables_initializer(self.resident_inputs)
+
+    def _input(self, dtype, shape, name):
+        """Placeholder of a data input, defaulting to a resident copy if set_resident_inputs()."""
+        if not self.resident or self.inference_only:
+            return tf.placeholder(dtype, shape=shape, name=name)
+        upload = tf.placeholder(dtype, shape=shape, name=name + '_upload')
+        resident = tf.Variable(upload, trainable=False, collections=[], validate_shape=False,
+                               name=name + '_resident')
+        x = tf.placeholder_with_default(resident, shape=shape, name=name)
+        self.resident_inputs.append(resident)
+        self.resident_uploads[x] = upload
+        return x
+
+    def _init_entities(self):
+        """Select the rows of the mode matrices referenced in the batch.
+
+        Each entity is projected once per batch, whatever the number of its
+        occurrences and the size of the mode matrix.
+        """
+        self.entity_index = [None] * self.n_modes
+        self.entity_rows = [None] * self.n_modes
+        for m in range(self.n_modes):
+            with tf.name_scope('entities_mode_{}'.format(m + 1)):
+                entities, self.entity_index[m] = tf.unique(self.train_x[m])
+                if self.input_type == 'dense':
+                    rows = tf.gather(self.mode_matrices[m][0], entities)
+                    rows.set_shape([None, self.input_width[m]])
+                    self.entity_rows[m] = rows
+                else:
+                    indptr, indices, values = self.mode_matrices[m]
+                    segment_ids, columns, data = gather_csr_rows(indptr, indices, values, entities)
+                    self.entity_rows[m] = (segment_ids, columns, data, tf.shape(entities)[0])
+
     def _batch_norm(self, Z, s, b):
         eps = 1e-5
         # Calculate batch mean and variance
@@ -216,16 +380,55 @@ class SFMCore():
             norm = tf.nn.l2_loss(W, name=node_name)
         return norm
 
+    def _init_reg_scales(self):
+        """Per-feature scales of the active-row penalties, see lazy_reg."""
+        self.reg_scale_inputs = [None] * self.n_modes
+        self.reg_scales = [None] * self.n_modes
+        if not self.lazy_reg or self.isRelational or self.input_type not in ('sparse', 'index'):
+            self.init_reg_scales = None
+            return
+        for m in range(self.n_modes):
+            self.reg_scale_inputs[m] = tf.placeholder(tf.float32, shape=[None], name='reg_scale_m{}'.format(m))
+            self.reg_scales[m] = tf.Variable(self.reg_scale_inputs[m], trainable=False, collections=[],
+                                             validate_shape=False, name='reg_scale_resident_m{}'.format(m))
+        self.init_reg_scales = tf.variables_initializer(self.reg_scales)
+
+    def _active_regularizer(self, W, m, node_name):
+        """Penalty of the rows of W used by the batch, see lazy_reg."""
+        if self.input_type == 'sparse':
+            columns = self.raw_indices[m][:, 1]
+        elif self.train_weights[m] is not None:
+            columns = tf.boolean_mask(self.train_x[m], tf.not_equal(self.train_weights[m], 0))
+        else:
+            columns = self.train_x[m]
+        rows = tf.gather(W, columns)
+        if self.reg_type == 'L1':
+            norms = tf.reduce_sum(tf.abs(rows), axis=1)
+        else:
+            norms = tf.reduce_sum(tf.square(rows), axis=1) / 2
+        batch_size = tf.cast(tf.shape(self.train_y)[0], tf.float32)
+        return tf.divide(tf.reduce_sum(tf.gather(self.reg_scales[m], columns) * norms), batch_size,
+                         name=node_name)
+
+    def _add_penalty(self, norm, W=None, m=None):
+        self.full_regularization += norm
+        if W is not None and self.reg_scales[m] is not None:
+            node_name = 'active_' + norm.op.name.split('/')[-1]
+            norm = self._active_regularizer(W, m, node_name)
+        self.regularization += norm
+
     def _init_regular(self):
         self.regularization = 0
         tf.summary.scalar('bias', self.b)
 
         self.regularization = 0
+        self.full_regularization = 0
+        self._init_reg_scales()
         for m in range(self.n_modes):
             node_name = 'regularization_penalty_v0_m{}'.format(m)
             norm = self._regularizer_func(self.W[0][m],node_name)
             tf.summary.scalar('norm_W_v0_m{}'.format(m), norm)
-            self.regularization += norm
+            self._add_penalty(norm, self.W[0][m], m)
         for i, modes in enumerate(self.view_list):
             v = i + 1
             for m in set(modes):
@@ -235,7 +438,7 @@ class SFMCore():
                     tf.summary.scalar('norm_Bias_v{}_m{}'.format(v,m), norm)
                 except:
                     print('bias mode {} shared in view {}'.format(m,v))
-                self.regularization += norm
+                self._add_penalty(norm)
                 if self.view_rank > 0:
                     try:
                         node_name = 'regularization_penalty_v{}_m{}'.format(v,m)
@@ -243,15 +446,17 @@ class SFMCore():
                         tf.summary.scalar('norm_W_v{}_m{}'.format(v,m), norm)
                     except:
                         print('mode {} shared in view {}'.format(m,v))
-                    self.regularization += norm
+                    self._add_penalty(norm, self.W[v][m-1], m-1)
 
         for v in range(len(self.view_list)):
             norm = self._regularizer_func(self.Phi[:,v], 'regularization_penalty_phi{}'.format(v+1))
             tf.summary.scalar('norm_Phi_v{}'.format(v+1), norm)
         node_name = 'regularization_penalty_phi'
         norm = self._regularizer_func(self.Phi, node_name)
-        self.regularization += norm
+        self._add_penalty(norm)
         tf.summary.scalar('regularization_penalty', self.regularization)
+        if self.reg_scales[0] is not None:
+            tf.summary.scalar('full_regularization_penalty', self.full_regularization)
 
     def _init_loss(self):
         self.loss = self.loss_function(self.outputs, self.train_y)
@@ -269,34 +474,48 @@ class SFMCore():
         self.prod_embedding = [None] * self.n_views
         self.view_contribution = [None] * self.n_views
 
+        if self.isRelational:
+            self._init_entities()
+
         for m in range(self.n_modes):
             self.XW_cache[m] = self._view_mode_embedding(0, m)
 
+        # without view-specific factors and with the biases fixed at zero,
+        # the embedding of a mode is the same in every view, so the views
+        # share the products of their common modes
+        shared = self.view_rank == 0 and not self.isFullOrder
+        # modes used by the most views first, so that common subsets are common prefixes
+        counts = Counter(m for modes in self.view_list for m in set(modes))
         for i, modes in enumerate(self.view_list):
             v = i + 1
+            # noting that the modes given in the input start from 1
+            modes = tuple(sorted(set(modes), key=lambda m: (-counts[m], m)))
             with tf.name_scope('view_{}'.format(v)) as scope:
-                XW_list = [None] * self.n_modes
-                # noting that the modes given in the input start from 1
-                for m in modes:
-                    with tf.name_scope('mode_{}'.format(m)) as scope:
-                        if self.view_rank > 0:
-                            XW = self._view_mode_embedding(v, m - 1)
-                            XW_list[m-1] = tf.concat(axis=1, values=[self.XW_cache[m-1], XW], name='XW')
-                        else:
-                            XW_list[m-1] = self.XW_cache[m-1]
-                        XW_list[m-1] += self.Bias[v][m-1]
-#                        XW_list[m-1] = self._batch_norm(XW_list[m-1], self.S[m-1], self.Bias[v][m-1])
-#                        XW_list[m-1] = self._layer_norm(XW_list[m-1], self.S[m-1], self.Bias[v][m-1])
-
-                # the reduction_indices in the reduce_prod does not handle scalar, 
-                # so we need to transform it to a tensor
-                embedding_tensor = tf.stack([xw for xw in XW_list if xw is not None],axis=2, name='embedding_tensor')
-                self.prod_embedding[i] = tf.reduce_prod(embedding_tensor, axis=[2], name='prod_embedding')
+                if shared:
+                    prod = self._shared_product(modes)
+                else:
+                    # multiply incrementally instead of stacking the mode embeddings
+                    prod = None
+                    for m in modes:
+                        with tf.name_scope('mode_{}'.format(m)) as scope:
+                            if self.view_rank > 0:
+                                XW = self._view_mode_embedding(v, m - 1)
+                                XW = tf.concat(axis=1, values=[self.XW_cache[m-1], XW], name='XW')
+                            else:
+                                XW = self.XW_cache[m-1]
+                            XW += self.Bias[v][m-1]
+#                            XW = self._batch_norm(XW, self.S[m-1], self.Bias[v][m-1])
+#                            XW = self._layer_norm(XW, self.S[m-1], self.Bias[v][m-1])
+                        prod = XW if prod is None else prod * XW
+                self.prod_embedding[i] = tf.identity(prod, name='prod_embedding')
 
                 self.view_contribution[i] = matmul_wrapper(self.prod_embedding[i], tf.reshape(self.Phi[:,i],(r,1)), 'dense')
-                tf.summary.histogram('view_contribution{}'.format(v), self.view_contribution[i])
+                if not self.inference_only:
+                    tf.summary.histogram('view_contribution{}'.format(v), self.view_contribution[i])
 
-        self.outputs += tf.reduce_sum(self.view_contribution, axis=[0], name='output')
+        self.outputs += tf.add_n(self.view_contribution, name='output')
+        if self.inference_only:
+            return
         tf.summary.histogram('output', self.outputs)
 
         with tf.name_scope('loss') as scope:
@@ -305,27 +524,102 @@ class SFMCore():
         with tf.name_scope('regularization') as scope:
             self._init_regular()
 
+    def _shared_product(self, modes):
+        """Product of the view-independent embeddings XW_cache of modes (from 1).
+
+        Products are cached in prod_view by tuple of modes and built on the
+        product of the longest prefix, so views whose sorted modes start
+        alike compute their common part once.
+        """
+        if modes not in self.prod_view:
+            XW = self.XW_cache[modes[-1] - 1]
+            if len(modes) == 1:
+                self.prod_view[modes] = XW
+            else:
+                with tf.name_scope('prod_modes_' + '_'.join(str(m) for m in modes)):
+                    self.prod_view[modes] = self._shared_product(modes[:-1]) * XW
+        return self.prod_view[modes]
+
     def _view_mode_embedding(self, v, m):
         if self.isRelational:
-            modeEmbedding = matmul_wrapper(self.mode_matrices[m], self.W[v][m], self.input_type)
-            XW = tf.nn.embedding_lookup(modeEmbedding, self.train_x[m])
+            # project the entities of the batch only, then broadcast to the samples
+            if self.input_type == 'dense':
+                entityEmbedding = tf.matmul(self.entity_rows[m], self._active_rows(self.W[v][m], m))
+            else:
+                segment_ids, columns, data, n_entities = self.entity_rows[m]
+                entityEmbedding = tf.unsorted_segment_sum(
+                    tf.gather(self.W[v][m], columns) * tf.expand_dims(data, 1),
+                    segment_ids, n_entities)
+            XW = tf.gather(entityEmbedding, self.entity_index[m])
+        elif self.input_type == 'index':
+            # the gradient only holds the rows of the ids in the batch
+            XW = tf.gather(self.W[v][m], self.train_x[m])
+            if self.train_weights[m] is not None:
+                XW = tf.reduce_sum(XW * tf.expand_dims(self.train_weights[m], 2), axis=1)
+        elif self.input_type == 'sparse':
+            # gather the rows of the nonzero columns instead of a sparse matmul,
+            # so that the gradient of the table only holds these rows
+            rows, columns = self.raw_indices[m][:, 0], self.raw_indices[m][:, 1]
+            XW = tf.unsorted_segment_sum(
+                tf.gather(self.W[v][m], columns) * tf.expand_dims(self.raw_values[m], 1),
+                rows, tf.cast(self.raw_shape[m][0], tf.int32))
         else:
-            XW = matmul_wrapper(self.train_x[m], self.W[v][m], self.input_type)
+            XW = matmul_wrapper(self.train_x[m], self._active_rows(self.W[v][m], m), self.input_type)
         return XW
 
+    def _active_rows(self, W, m):
+        """Rows of the factor table W of mode m matching the columns of the input."""
+        if self.input_width[m] is not None:
+            return W
+        if self.isRelational:
+            n_columns = tf.shape(self.entity_rows[m])[1]
+        else:
+            n_columns = tf.shape(self.train_x[m])[1]
+        return W[:n_columns]
+
+    def _init_row_updates(self):
+        self.row_updates = [[None] * self.n_modes for i in range(self.n_views + 1)]
+        for v, tables in enumerate(self.W):
+            for m, W in enumerate(tables):
+                if W is None or self.capacity_list[m] == self.n_feature_list[m]:
+                    continue
+                with tf.name_scope('row_update_v{}_m{}'.format(v, m + 1)):
+                    rows = tf.placeholder(tf.int64, shape=[None], name='rows')
+                    values = tf.placeholder(tf.float32, shape=[None, W.get_shape()[1]], name='values')
+                    self.row_updates[v][m] = (rows, values, tf.scatter_update(W, rows, values))
+
 
     def _init_target(self):
 #        reg_losses = tf.get_collection(tf.GraphKeys.REGULARIZATION_LOSSES)
-        self.target = self.reduced_loss + self.reg * self.regularization
+        self.target = self.reduced_loss
+        if self.reg != 0:
+            # even multiplied by 0, the penalty of the full tables would send
+            # dense gradients to every factor table, see LazyAdamOptimizer
+            self.target += self.reg * self.regularization
 
         self.checked_target = tf.verify_tensor_all_finite(
             self.target,
             msg='NaN or Inf in target value', name='target')
         tf.summary.scalar('target', self.checked_target)
 
-    def build_graph(self):
-        """Build computational graph according to params."""
+    def build_graph(self, inference_only=False):
+        """Build computational graph according to params.
+
+        Parameters
+        ----------
+        inference_only : bool, default: False
+            Build only the parameters, the inputs and the output path: no loss,
+            regularization, target check, optimizer or summaries. Such a graph
+            can restore a checkpoint of a training graph and predict, but
+            cannot be trained.
+        """
         assert self.n_feature_list is not None
+        if self.capacity_list is None:
+            self.capacity_list = list(self.n_feature_list)
+        # static width of the inputs of each mode, None if its tables have spare rows
+        self.input_width = [None if capacity > n_features else n_features
+                            for n_features, capacity in zip(self.n_feature_list, self.capacity_list)]
+        self.inference_only = inference_only
         self.graph = tf.Graph()
         with self.graph.as_default():
             with tf.name_scope('params') as scope:
@@ -337,12 +631,18 @@ class SFMCore():
             with tf.name_scope('mainBlock') as scope:
                 self._init_main_block()
 
-            self._init_target()
-
-            self.trainer = self.optimizer.minimize(self.checked_target)
+            if inference_only:
+                self.trainer = None
+                self.summary_op = None
+                self.row_updates = None
+                self.init_reg_scales = None
+            else:
+                self._init_row_updates()
+                self._init_target()
+                self.trainer = self.optimizer.minimize(self.checked_target)
+#                self.post_step = self._norm_constraint_op()
+                self.summary_op = tf.summary.merge_all()
             self.init_all_vars = tf.global_variables_initializer()
-#            self.post_step = self._norm_constraint_op()
-            self.summary_op = tf.summary.merge_all()
             self.saver = tf.train.Saver()
 
 def matmul_wrapper(A, B, optype):
@@ -366,6 +666,34 @@ def matmul_wrapper(A, B, optype):
     else:
         raise NameError('Unknown input type in matmul_wrapper')
 
+def gather_csr_rows(indptr, indices, values, rows):
+    """Gather rows of a CSR matrix held in tensors.
+
+    Parameters
+    ----------
+    indptr, indices, values : tf.Tensor
+        CSR arrays of the matrix: int64 row offsets, int64 column indices
+        and float32 values.
+    rows : tf.Tensor of int64
+        Rows to gather.
+
+    Returns
+    -------
+    segment_ids : tf.Tensor, position in rows of each gathered element
+    columns : tf.Tensor, column index of each gathered element
+    data : tf.Tensor, value of each gathered element
+    """
+    starts = tf.gather(indptr, rows)
+    lengths = tf.gather(indptr, rows + 1) - starts
+    offsets = tf.cumsum(lengths, exclusive=True)
+    total = tf.reduce_sum(lengths)
+    # mark the first element of each row, empty rows share the mark of the next one
+    marks = tf.unsorted_segment_sum(tf.ones_like(offsets), offsets,
+                                   tf.cast(total + 1, tf.int32))[:total]
+    segment_ids = tf.cumsum(marks) - 1
+    positions = tf.range(total) - tf.gather(offsets, segment_ids) + tf.gather(starts, segment_ids)
+    return segment_ids, tf.gather(indices, positions), tf.gather(values, positions)
+
 #def L2Ball_update(var_matrix, maxnorm=1.0):
     #'''Dense update operation that ensures all columns in var_matrix 
         #have a Euclidean norm equal to maxnorm. 
@@ -0,0 +1,638 @@
+"""
+    Input pipeline utilities: datasets converted once into the feed format of SFMCore
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+from collections import deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+
+def batch_bounds(n_samples, batch_size=-1):
+    """Yield (start, stop) of consecutive mini-batches.
+
+    Parameters
+    ----------
+    n_samples : int
+    batch_size : int
+        Size of batches.
+        Use -1 for full-size batches
+    """
+    if batch_size == -1:
+        batch_size = n_samples
+    if batch_size < 1:
+        raise ValueError('Parameter batch_size={} is unsupported'.format(batch_size))
+    for i in range(0, n_samples, batch_size):
+        yield i, min(i + batch_size, n_samples)
+
+
+def n_rows(X_in_mode):
+    """Number of samples of a mode, given as an array or an (ids, weights) bag."""
+    if isinstance(X_in_mode, tuple):
+        return X_in_mode[0].shape[0]
+    return X_in_mode.shape[0]
+
+
+def take_rows(X_in_mode, rows):
+    """Rows (slice or index array) of a mode, given as an array or an (ids, weights) bag."""
+    if isinstance(X_in_mode, tuple):
+        return tuple(x[rows] for x in X_in_mode)
+    return X_in_mode[rows]
+
+
+def n_index_features(X_in_mode):
+    """Number of features of an 'index' mode: the largest id plus one."""
+    ids = X_in_mode[0] if isinstance(X_in_mode, tuple) else X_in_mode
+    return int(np.max(ids)) + 1 if np.size(ids) > 0 else 0
+
+
+class FeatureHasher(object):
+    """Hashing trick: maps raw feature ids to a fixed number of buckets.
+
+    Parameters
+    ----------
+    n_buckets : int
+        Number of columns after hashing, i.e. rows of the factor tables.
+
+    signed : bool, default: False
+        Multiply every value by a +1/-1 sign drawn from the hash of its id,
+        so that colliding features cancel out in expectation instead of
+        adding up.
+
+    seed : int, default: 0
+    """
+    def __init__(self, n_buckets, signed=False, seed=0):
+        if n_buckets < 1:
+            raise ValueError('Parameter n_buckets={} is unsupported'.format(n_buckets))
+        self.n_buckets = n_buckets
+        self.signed = signed
+        self.seed = seed
+
+    def _hash(self, ids):
+        # finalizer of MurmurHash3, wrapping 64-bit arithmetic
+        with np.errstate(over='ignore'):
+            h = np.asarray(ids).astype(np.uint64) ^ np.uint64(self.seed)
+            h = (h ^ (h >> np.uint64(33))) * np.uint64(0xff51afd7ed558ccd)
+            h = (h ^ (h >> np.uint64(33))) * np.uint64(0xc4ceb9fe1a85ec53)
+            return h ^ (h >> np.uint64(33))
+
+    def hash(self, ids, values):
+        """Bucket of each raw id, and its value with the sign applied if signed.
+
+        Returns
+        -------
+        columns : np.array of int64
+        values : np.array of float32
+        """
+        h = self._hash(ids)
+        columns = (h % np.uint64(self.n_buckets)).astype(np.int64)
+        values = np.asarray(values, dtype=np.float32)
+        if self.signed:
+            values = np.where((h >> np.uint64(63)).astype(bool), -values, values)
+        return columns, values
+
+    def transform(self, X):
+        """Hash the columns of a sparse matrix.
+
+        Parameters
+        ----------
+        X : scipy.sparse matrix, shape (n_samples, any)
+            Column indices are the raw feature ids.
+
+        Returns
+        -------
+        X_hashed : scipy.sparse.csr_matrix, shape (n_samples, n_buckets)
+            Values of ids sharing a bucket are summed.
+        """
+        X = sp.csr_matrix(X)
+        columns, values = self.hash(X.indices, X.data)
+        # sum_duplicates() rewrites indptr in place, it must not be the one of X
+        X_hashed = sp.csr_matrix((values, columns, X.indptr.copy()), shape=(X.shape[0], self.n_buckets))
+        X_hashed.sum_duplicates()
+        return X_hashed
+
+
+def make_hashers(hash_buckets, n_modes, signed=False):
+    """FeatureHasher of each mode, None for the modes that are not hashed.
+
+    Parameters
+    ----------
+    hash_buckets : int, list of {int, None}, or None
+        Number of buckets of every mode, or of each mode.
+
+    Returns
+    -------
+    hashers : list of {FeatureHasher, None} or None if hash_buckets is None
+    """
+    if hash_buckets is None:
+        return None
+    if np.isscalar(hash_buckets):
+        hash_buckets = [hash_buckets] * n_modes
+    assert len(hash_buckets) == n_modes
+    return [None if n is None else FeatureHasher(n, signed) for n in hash_buckets]
+
+
+class SparseMode(object):
+    """CSR matrix stored once in the (indices, values, shape) format of tf.SparseTensor.
+
+    Row ids are stored relative to the start of their block of block_size
+    rows, so that a slice aligned on the blocks is handed out as zero-copy
+    views of the underlying arrays.
+
+    Parameters
+    ----------
+    X : scipy.sparse.csr_matrix, shape (n_samples, n_features)
+
+    block_size : int or None
+        Alignment of the mini-batches, usually the batch size.
+        None for a single block.
+
+    hasher : FeatureHasher or None
+        Hash the column indices of X, see FeatureHasher.
+
+    Attributes
+    ----------
+    indptr : np.array of int64, shape (n_samples + 1,)
+        Row offsets in indices and values.
+
+    indices : np.array of int64, shape (nnz, 2)
+        (block-relative row, column) of each stored element.
+
+    values : np.array of float32, shape (nnz,)
+    """
+    def __init__(self, X, block_size=None, hasher=None):
+        X = sp.csr_matrix(X)
+        self.shape = X.shape
+        n_rows = X.shape[0]
+        if block_size is None or block_size == -1 or block_size > n_rows:
+            block_size = n_rows
+        self.block_size = max(block_size, 1)
+        self.indptr = X.indptr.astype(np.int64)
+        rows = np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(self.indptr))
+        self.indices = np.empty((X.nnz, 2), dtype=np.int64)
+        self.indices[:, 0] = rows % self.block_size
+        if hasher is None:
+            self.indices[:, 1] = X.indices
+            self.values = X.data.astype(np.float32)
+        else:
+            # colliding ids stay separate entries, summed by the sparse matmul
+            self.indices[:, 1], self.values = hasher.hash(X.indices, X.data)
+            self.shape = (n_rows, hasher.n_buckets)
+
+    def slice(self, start, stop):
+        """Feed triple of rows [start, stop), with row ids rebased to start."""
+        a, b = self.indptr[start], self.indptr[stop]
+        indices = self.indices[a:b]
+        if start % self.block_size != 0 or stop - start > self.block_size:
+            # the slice spans several blocks, rebase row ids explicitly
+            indices = indices.copy()
+            indices[:, 0] = np.repeat(np.arange(stop - start, dtype=np.int64),
+                                      np.diff(self.indptr[start:stop + 1]))
+        shape = np.array([stop - start, self.shape[1]], dtype=np.int64)
+        return indices, self.values[a:b], shape
+
+    def take(self, rows):
+        """Feed triple of the given rows, gathered in the given order."""
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        indices = np.empty((len(positions), 2), dtype=np.int64)
+        indices[:, 0] = np.repeat(np.arange(len(rows), dtype=np.int64), lengths)
+        indices[:, 1] = self.indices[positions, 1]
+        shape = np.array([len(rows), self.shape[1]], dtype=np.int64)
+        return indices, self.values[positions], shape
+
+
+def prepare_mode_matrices(mode_matrices, input_type, hashers=None):
+    """Convert mode matrices once into the format loaded into SFMCore.mode_matrix_inputs.
+
+    hashers : list of {FeatureHasher, None} or None
+        Hash the column indices of the sparse mode matrices.
+
+    Returns
+    -------
+    prepared : list of list of np.array
+        [float32 matrix] for 'dense' input, [indptr, indices, data] CSR
+        arrays as int64, int64 and float32 for 'sparse' input.
+    """
+    prepared = [None] * len(mode_matrices)
+    for m, mode_matrix in enumerate(mode_matrices):
+        if input_type == 'dense':
+            prepared[m] = [np.ascontiguousarray(mode_matrix, dtype=np.float32)]
+        else:
+            mode_matrix = sp.csr_matrix(mode_matrix)
+            if hashers is not None and hashers[m] is not None:
+                indices, data = hashers[m].hash(mode_matrix.indices, mode_matrix.data)
+            else:
+                indices, data = mode_matrix.indices, mode_matrix.data
+            prepared[m] = [mode_matrix.indptr.astype(np.int64),
+                           indices.astype(np.int64),
+                           data.astype(np.float32)]
+    return prepared
+
+
+def load_shard(paths):
+    """Load the per-mode files of one shard.
+
+    '.npy' files are memory-mapped read-only, '.npz' files are loaded
+    with scipy.sparse.load_npz and converted to CSR.
+
+    Returns
+    -------
+    X_ : list of {numpy.memmap, scipy.sparse.csr_matrix}, shape: [n_modes]
+    """
+    X_ = [None] * len(paths)
+    for m, path in enumerate(paths):
+        if path.endswith('.npz'):
+            X_[m] = sp.load_npz(path).tocsr()
+        else:
+            X_[m] = np.load(path, mmap_mode='r')
+    return X_
+
+
+def epoch_batches(n_samples, batch_size=-1, shuffle='index'):
+    """Yield the rows of each mini-batch of one epoch.
+
+    Parameters
+    ----------
+    n_samples : int
+
+    batch_size : int
+        Size of batches.
+        Use -1 for full-size batches
+
+    shuffle : {'index', 'block', None}, default: 'index'
+        'index' permutes an index array and gathers the rows of each batch
+        on demand. 'block' only shuffles the order of the batches, which
+        keeps every batch a contiguous (zero-copy) slice but fixes its
+        composition across epochs. None disables shuffling.
+        A full-size batch is never shuffled since it does not affect the
+        gradient.
+
+    Yields
+    -------
+    rows : slice or np.array of int
+        Rows of the batch, as accepted by PreparedDataset.feeddict().
+    """
+    bounds = list(batch_bounds(n_samples, batch_size))
+    if shuffle is None or len(bounds) <= 1:
+        for start, stop in bounds:
+            yield slice(start, stop)
+    elif shuffle == 'index':
+        perm = np.random.permutation(n_samples)
+        for start, stop in bounds:
+            yield perm[start:stop]
+    elif shuffle == 'block':
+        for i in np.random.permutation(len(bounds)):
+            yield slice(*bounds[i])
+    else:
+        raise ValueError('Unknown shuffle mode {}'.format(shuffle))
+
+
+def prefetch(tasks, depth=2, n_threads=1):
+    """Run tasks on background threads ahead of the consumer.
+
+    Parameters
+    ----------
+    tasks : iterable of callables
+        Zero-argument functions, e.g. the feed dict builders of successive
+        mini-batches.
+
+    depth : int, default: 2
+        Maximum number of results prepared in advance.
+        Use 0 to run the tasks synchronously.
+
+    n_threads : int, default: 1
+        Number of worker threads.
+
+    Yields
+    -------
+    Results of the tasks, in order.
+    """
+    if depth < 1:
+        for task in tasks:
+            yield task()
+        return
+    pool = ThreadPool(n_threads)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(task))
+            if len(pending) > depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+class PreparedDataset(object):
+    """Dataset converted once into the feed format of SFMCore.
+
+    Every mode is converted a single time into contiguous arrays: float32
+    for dense input, SparseMode for sparse input, int64 ids (and float32
+    weights for bags) for index input and int64 row indicators for
+    relational input. Mini-batches are then handed out as slices of
+    these arrays instead of being converted on every call.
+
+    Parameters
+    ----------
+    X_ : list of {numpy.array, scipy.sparse.csr_matrix, tuple}, shape: [n_modes]
+        Samples of each mode, or the row indicators of the mode matrices
+        in the relational case. For 'index' input, ids of shape (n_samples,)
+        or a bag (ids, weights) of arrays of shape (n_samples, bag_size).
+
+    y_ : np.array or None, shape (n_samples,)
+        Target vector relative to X.
+
+    input_type : str, 'dense', 'sparse' or 'index'
+
+    batch_size : int, default: -1
+        Size of the mini-batches handed out by .feeddicts().
+        Use -1 for full-size batches
+
+    isRelational : bool, default: False
+        Whether X_ holds the row indicators of the mode matrices, which
+        are kept resident in the graph (see SFMCore.mode_matrices).
+
+    shuffle : {'index', 'block', None}, default: None
+        Order of the mini-batches handed out by .feeddicts(),
+        see epoch_batches().
+
+    hashers : list of {FeatureHasher, None} or None
+        Hash the column indices of the sparse modes, see SparseMode.
+    """
+    def __init__(self, X_, y_=None, input_type='dense', batch_size=-1, isRelational=False,
+                 shuffle=None, hashers=None):
+        assert isinstance(X_, list)
+        self.n_samples = n_rows(X_[0])
+        # samples fed per epoch
+        self.epoch_size = self.n_samples
+        self.input_type = input_type
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.isRelational = isRelational
+        self.modes = [None] * len(X_)
+        for m, X_in_mode in enumerate(X_):
+            if self.isRelational:
+                self.modes[m] = np.ascontiguousarray(X_in_mode, dtype=np.int64)
+            elif input_type == 'dense':
+                self.modes[m] = np.ascontiguousarray(X_in_mode, dtype=np.float32)
+            elif input_type == 'index':
+                if isinstance(X_in_mode, tuple):
+                    ids, weights = X_in_mode
+                    self.modes[m] = (np.ascontiguousarray(ids, dtype=np.int64),
+                                     np.ascontiguousarray(weights, dtype=np.float32))
+                else:
+                    self.modes[m] = np.ascontiguousarray(X_in_mode, dtype=np.int64)
+            else:
+                self.modes[m] = SparseMode(X_in_mode, batch_size,
+                                           None if hashers is None else hashers[m])
+        self.y = None
+        if y_ is not None:
+            self.y = np.ascontiguousarray(y_, dtype=np.float32)
+
+    def feature_counts(self, m, minlength=0):
+        """Number of occurrences of each feature of mode m in the samples fed per epoch.
+
+        Only for 'sparse' and 'index' input, not relational.
+
+        Returns
+        -------
+        counts : np.array of int, shape (max(minlength, n_features),)
+        """
+        mode = self.modes[m]
+        if self.input_type == 'sparse':
+            columns = mode.indices[:, 1]
+        elif isinstance(mode, tuple):
+            ids, weights = mode
+            columns = ids[weights != 0]
+        else:
+            columns = mode
+        return np.bincount(columns, minlength=minlength)
+
+    def feeddict(self, core, rows):
+        """Prepare feed dict for session.run() from a mini-batch.
+
+        Parameters
+        ----------
+        core : SFMCore
+            Core used for extract appropriate placeholders
+
+        rows : slice or np.array of int
+            Contiguous rows are handed out as views, arbitrary rows are
+            gathered into a batch-sized copy.
+        """
+        contiguous = isinstance(rows, slice)
+        if contiguous:
+            start, stop, _ = rows.indices(self.n_samples)
+        fd = {}
+        for m, mode in enumerate(self.modes):
+            if self.isRelational or self.input_type == 'dense':
+                fd[core.train_x[m]] = mode[rows]
+            elif self.input_type == 'index':
+                if isinstance(mode, tuple):
+                    fd[core.train_x[m]], fd[core.train_weights[m]] = mode[0][rows], mode[1][rows]
+                else:
+                    fd[core.train_x[m]] = mode[rows]
+            else:
+                (fd[core.raw_indices[m]], fd[core.raw_values[m]],
+                    fd[core.raw_shape[m]]) = mode.slice(start, stop) if contiguous else mode.take(rows)
+        if self.y is not None:
+            fd[core.train_y] = self.y[rows]
+        return fd
+
+    def feeddicts(self, core, prefetch_depth=0, n_threads=1, timer=None):
+        """Yield the feed dicts of the mini-batches of one epoch.
+
+        With prefetch_depth > 0 the next feed dicts are built on
+        n_threads background threads while the current one is consumed.
+        If a PhaseTimer is given, the batch order generation is accounted
+        to phase 'shuffle' and the feed dict construction to phase 'batch'.
+        """
+        batches = epoch_batches(self.n_samples, self.batch_size, self.shuffle)
+        feeddict = self.feeddict
+        if timer is not None:
+            batches = timer.iterate('shuffle', batches)
+            feeddict = timer.timed('batch', feeddict)
+        tasks = (partial(feeddict, core, rows) for rows in batches)
+        return prefetch(tasks, prefetch_depth, n_threads)
+
+
+def reg_scales(counts, epoch_size):
+    """Penalty scales of the rows of a factor table used by lazy_reg.
+
+    Each occurrence of a feature in a mini-batch penalizes its row scaled
+    by epoch_size / frequency of the feature, so that over an epoch every
+    present feature is penalized once in expectation, as by the full
+    penalty. Features absent from the dataset get 0.
+
+    Parameters
+    ----------
+    counts : np.array, shape (n_features,)
+        Occurrences of each feature in the samples fed per epoch,
+        see PreparedDataset.feature_counts().
+
+    epoch_size : int
+        Number of samples fed per epoch.
+
+    Returns
+    -------
+    scales : np.array of float32, shape (n_features,)
+    """
+    counts = np.asarray(counts)
+    present = counts > 0
+    return np.where(present, epoch_size / np.where(present, counts, 1), 0).astype(np.float32)
+
+
+class NegativeSampler(object):
+    """Draw negative tuples of ids by corrupting positive ones.
+
+    Every negative copies a positive tuple and replaces the id of one of
+    corrupt_modes, chosen uniformly, by a sampled id. Negatives are not
+    checked against the positives: with many ids, collisions are rare.
+
+    Parameters
+    ----------
+    n_ids_list : list of int, shape: [n_modes]
+        Number of ids of each mode: rows of the mode matrix in the
+        relational case, features for 'index' input.
+
+    corrupt_modes : list of int or None
+        # index starting from 1
+        Modes whose id may be replaced. None for all the modes.
+
+    n_negatives : int, default: 4
+        Number of negatives drawn per positive.
+
+    sampling : {'uniform', 'popularity'}, default: 'uniform'
+        'popularity' draws the ids with probability proportional to
+        counts ** power, so that frequent ids also appear as negatives.
+
+    counts : list of np.array or None
+        Number of occurrences of each id of each mode among the positives,
+        required for 'popularity' sampling.
+
+    power : float, default: 0.75
+        Exponent of the counts for 'popularity' sampling.
+    """
+    def __init__(self, n_ids_list, corrupt_modes=None, n_negatives=4, sampling='uniform',
+                 counts=None, power=0.75):
+        if sampling not in ('uniform', 'popularity'):
+            raise ValueError('Unknown sampling {}, use \'uniform\' or \'popularity\''.format(sampling))
+        if n_negatives < 1:
+            raise ValueError('Parameter n_negatives={} is unsupported'.format(n_negatives))
+        self.n_ids_list = n_ids_list
+        self.corrupt_modes = list(corrupt_modes or range(1, len(n_ids_list) + 1))
+        self.n_negatives = n_negatives
+        self.sampling = sampling
+        self.cdfs = None
+        if sampling == 'popularity':
+            if counts is None:
+                raise ValueError('counts are required for popularity sampling')
+            self.cdfs = [np.cumsum(np.asarray(c, dtype=np.float64) ** power) for c in counts]
+
+    def expected_counts(self, m, counts):
+        """Expected occurrences of each id of mode m (from 0) in an epoch.
+
+        Parameters
+        ----------
+        counts : np.array, shape (>= n_ids,)
+            Occurrences of each id among the positives.
+
+        Returns
+        -------
+        expected : np.array of float, same shape as counts
+            Occurrences among the positives and their negatives.
+        """
+        counts = np.asarray(counts, dtype=np.float64)
+        # fraction of the negatives whose id of mode m is replaced
+        share = 1.0 / len(self.corrupt_modes) if m + 1 in self.corrupt_modes else 0.0
+        if self.cdfs is None:
+            probs = np.full(self.n_ids_list[m], 1.0 / self.n_ids_list[m])
+        else:
+            probs = np.diff(np.concatenate(([0.0], self.cdfs[m]))) / self.cdfs[m][-1]
+        expected = counts * (1 + self.n_negatives * (1 - share))
+        expected[:len(probs)] += self.n_negatives * share * counts.sum() * probs
+        return expected
+
+    def draw(self, m, size):
+        """Sample size ids of mode m (from 0)."""
+        if self.cdfs is None:
+            return np.random.randint(self.n_ids_list[m], size=size)
+        cdf = self.cdfs[m]
+        return np.searchsorted(cdf, np.random.random_sample(size) * cdf[-1], side='right')
+
+    def sample(self, positives):
+        """Positives followed by their negatives.
+
+        Parameters
+        ----------
+        positives : list of np.array of int, shape: [n_modes]
+            Ids of the positive tuples in each mode, shape (n,).
+
+        Returns
+        -------
+        ids : list of np.array of int64, shape: [n_modes]
+            Ids of the n positive and n * n_negatives negative tuples.
+
+        labels : np.array of int, shape (n * (1 + n_negatives),)
+            1 for the positives, 0 for the negatives.
+        """
+        n = len(positives[0])
+        ids = [np.tile(np.asarray(x, dtype=np.int64), 1 + self.n_negatives) for x in positives]
+        corrupted = np.random.randint(len(self.corrupt_modes), size=n * self.n_negatives)
+        for i, m in enumerate(self.corrupt_modes):
+            rows = n + np.flatnonzero(corrupted == i)
+            ids[m - 1][rows] = self.draw(m - 1, len(rows))
+        labels = np.zeros(n * (1 + self.n_negatives), dtype=np.int64)
+        labels[:n] = 1
+        return ids, labels
+
+
+class NegativeSamplingDataset(PreparedDataset):
+    """Positive tuples of ids completed by fresh negatives in every mini-batch.
+
+    Only the positives are stored; each mini-batch of batch_size positives
+    is fed along with its batch_size * n_negatives negatives drawn by the
+    sampler (on the prefetching threads if enabled), so every epoch sees
+    new negatives.
+
+    Parameters
+    ----------
+    X_ : list of np.array of int, shape: [n_modes]
+        Ids of the positive tuples: row indicators of the mode matrices in
+        the relational case, or ids for 'index' input (bags unsupported).
+
+    sampler : NegativeSampler
+
+    target_values : np.array, shape (2,)
+        Target fed for the label 0 (negatives) and 1 (positives),
+        e.g. the labels converted by preprocess_target().
+
+    See PreparedDataset for the other parameters.
+    """
+    def __init__(self, X_, sampler, target_values, input_type='index', batch_size=-1,
+                 isRelational=False, shuffle=None):
+        if any(isinstance(X_in_mode, tuple) for X_in_mode in X_):
+            raise ValueError('Negative sampling does not support bags of ids')
+        super(NegativeSamplingDataset, self).__init__(X_, None, input_type=input_type,
+                                                      batch_size=batch_size,
+                                                      isRelational=isRelational,
+                                                      shuffle=shuffle)
+        self.sampler = sampler
+        self.target_values = np.asarray(target_values, dtype=np.float32)
+        self.epoch_size = self.n_samples * (1 + sampler.n_negatives)
+
+    def feature_counts(self, m, minlength=0):
+        counts = super(NegativeSamplingDataset, self).feature_counts(m, minlength)
+        return self.sampler.expected_counts(m, counts)
+
+    def feeddict(self, core, rows):
+        ids, labels = self.sampler.sample([mode[rows] for mode in self.modes])
+        fd = dict((core.train_x[m], ids_in_mode) for m, ids_in_mode in enumerate(ids))
+        fd[core.train_y] = self.target_values[labels]
+        return fd
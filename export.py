@@ -0,0 +1,184 @@
+"""
+    Compact single-file export of trained Structural Factorization Machines
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import json
+import struct
+import numpy as np
+
+from .data import make_hashers
+from .inference import SFMScorer, StoredTable
+
+MAGIC = b'SFMX'
+VERSION = 1
+# arrays start on multiples of ALIGNMENT bytes in the file
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<4sIQ')
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def quantize(W, dtype):
+    """Convert a factor table to the storage dtype.
+
+    Parameters
+    ----------
+    W : np.array, shape (n_rows, rank)
+
+    dtype : str, 'float32', 'float16' or 'int8'
+        int8 values are scaled per column so that the largest absolute
+        value of each column maps to 127.
+
+    Returns
+    -------
+    values : np.array of dtype
+    scales : np.array of float32, shape (rank,), or None if dtype is not int8
+    """
+    if dtype == 'int8':
+        scales = np.abs(W).max(axis=0) / 127.0 if W.shape[0] > 0 else np.zeros(W.shape[1])
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        values = np.clip(np.round(W / scales), -127, 127).astype(np.int8)
+        return values, scales
+    if dtype in ('float32', 'float16'):
+        return W.astype(dtype), None
+    raise ValueError('Unknown dtype {}, use float32, float16 or int8'.format(dtype))
+
+
+def save_model(path, params, view_list, dtype='float32', config=None):
+    """Write the weights of a model into a single memory-mappable file.
+
+    The file holds a JSON header describing the arrays, followed by the
+    raw arrays, each aligned on 64 bytes.
+
+    Parameters
+    ----------
+    path : str
+
+    params : dict
+        Weights as returned by SFMBaseModel.export_weights().
+
+    view_list: list of int tuple
+        # index starting from 1
+        modes in each view structure, see SFMCore.
+
+    dtype : str, 'float32', 'float16' or 'int8', default: 'float32'
+        Storage type of the factor tables W, see quantize(). Bias and Phi
+        are always stored as float32.
+
+    config : dict or None
+        JSON-serializable settings stored along with the weights,
+        see read_config().
+    """
+    arrays = []
+    for name in ['W', 'Bias']:
+        for v, tables in enumerate(params[name]):
+            for m, value in enumerate(tables):
+                if value is None:
+                    continue
+                key = '{}/{}/{}'.format(name, v, m)
+                if name == 'W':
+                    value, scales = quantize(np.asarray(value), dtype)
+                    if scales is not None:
+                        arrays.append((key + '/scales', scales))
+                    arrays.append((key, value))
+                else:
+                    arrays.append((key, np.asarray(value, dtype=np.float32)))
+    arrays.append(('Phi', np.asarray(params['Phi'], dtype=np.float32)))
+
+    header = {
+        'view_list': [list(modes) for modes in view_list],
+        'n_modes': len(params['W'][0]),
+        'b': float(params['b']),
+        'dtype': dtype,
+        'config': config or {},
+        'arrays': {},
+    }
+    # the offsets are relative to the end of the header
+    offset = 0
+    for key, value in arrays:
+        header['arrays'][key] = {'offset': offset, 'dtype': value.dtype.str, 'shape': list(value.shape)}
+        offset = _aligned(offset + value.nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _aligned(_PREAMBLE.size + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for key, value in arrays:
+            f.seek(data_start + header['arrays'][key]['offset'])
+            f.write(np.ascontiguousarray(value).tobytes())
+        f.truncate(data_start + offset)
+
+
+def _read_header(f):
+    magic, version, header_size = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+    if magic != MAGIC:
+        raise ValueError('Not an exported SFM model')
+    if version > VERSION:
+        raise ValueError('Unsupported export format version {}'.format(version))
+    header = json.loads(f.read(header_size).decode('utf-8'))
+    return header, _aligned(_PREAMBLE.size + header_size)
+
+
+def read_config(path):
+    """Settings stored by save_model(), without loading the weights."""
+    with open(path, 'rb') as f:
+        return _read_header(f)[0]['config']
+
+
+def load_model(path, mmap=True):
+    """Load a file written by save_model() as an SFMScorer.
+
+    Only NumPy and SciPy are needed: the package imports TensorFlow only
+    for the estimators, so processes without TensorFlow can load and
+    score exported models.
+
+    Parameters
+    ----------
+    path : str
+
+    mmap : bool, default: True
+        Memory-map the arrays instead of reading them. Loading then costs
+        only the header, and processes loading the same file share the
+        pages of the weights through the OS page cache.
+
+    Returns
+    -------
+    scorer : SFMScorer
+        Factor tables are StoredTable instances dequantized on access.
+        Modes exported with hash_buckets are hashed as in training.
+    """
+    with open(path, 'rb') as f:
+        header, data_start = _read_header(f)
+        if mmap:
+            buffer = np.memmap(f, dtype=np.uint8, mode='r')
+        else:
+            f.seek(0)
+            buffer = np.frombuffer(f.read(), dtype=np.uint8)
+
+    def array(key):
+        spec = header['arrays'][key]
+        return np.ndarray(tuple(spec['shape']), dtype=np.dtype(str(spec['dtype'])),
+                          buffer=buffer, offset=data_start + spec['offset'])
+
+    n_views = len(header['view_list'])
+    n_modes = header['n_modes']
+    W = [[None] * n_modes for i in range(n_views + 1)]
+    Bias = [[None] * n_modes for i in range(n_views + 1)]
+    for v in range(n_views + 1):
+        for m in range(n_modes):
+            key = 'W/{}/{}'.format(v, m)
+            if key in header['arrays']:
+                scales = array(key + '/scales') if key + '/scales' in header['arrays'] else None
+                W[v][m] = StoredTable(array(key), scales)
+            key = 'Bias/{}/{}'.format(v, m)
+            if key in header['arrays']:
+                Bias[v][m] = array(key)
+    view_list = [tuple(modes) for modes in header['view_list']]
+    config = header['config']
+    hashers = make_hashers(config.get('hash_buckets'), n_modes, config.get('hash_sign', False))
+    return SFMScorer(view_list, W, Bias, array('Phi'), b=header['b'],
+                     input_type=config.get('input_type', 'dense'), hashers=hashers)
@@ -0,0 +1,464 @@
+"""
+    NumPy scoring engine for trained Structural Factorization Machines.
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+from .data import batch_bounds, n_rows, take_rows
+
+
+class StoredTable(object):
+    """
+    Factor table kept in its storage format and dequantized on access.
+
+    Only the rows that are read are converted to float32, so a table
+    memory-mapped from an exported model (see export.load_model) is never
+    copied as a whole by scoring.
+
+    Parameters
+    ----------
+    values : np.array, shape (n_rows, rank)
+        float32, float16 or int8 values.
+
+    scales : np.array or None, shape (rank,)
+        Per-column scales of int8 values, None otherwise.
+
+    block_size : int, default: 65536
+        Number of rows dequantized at once when multiplying dense inputs.
+    """
+    def __init__(self, values, scales=None, block_size=65536):
+        self.values = values
+        self.scales = scales
+        self.block_size = block_size
+        self.shape = values.shape
+
+    def __getitem__(self, rows):
+        table = self.values[rows].astype(np.float32)
+        if self.scales is not None:
+            table *= self.scales
+        return table
+
+    def __array__(self, dtype=None):
+        table = self[:]
+        return table if dtype is None else table.astype(dtype)
+
+    def rdot(self, X):
+        """X times the table, X being a numpy.array or a scipy.sparse matrix."""
+        if sp.issparse(X):
+            # dequantize the referenced rows only
+            X = X.tocsr()
+            rows, columns = np.unique(X.indices, return_inverse=True)
+            X = sp.csr_matrix((X.data, columns, X.indptr), shape=(X.shape[0], len(rows)))
+            return np.asarray(X.dot(self[rows]))
+        output = np.zeros((X.shape[0], self.shape[1]), dtype=np.float32)
+        for start, stop in batch_bounds(self.shape[0], self.block_size):
+            output += np.asarray(X[:, start:stop]).dot(self[start:stop])
+        return output
+
+
+def _dot(X, W):
+    if isinstance(W, StoredTable):
+        return W.rdot(X)
+    return np.asarray(X.dot(W))
+
+
+class SFMScorer(object):
+    """
+    Evaluates the output of a trained SFM from exported weights, without
+    building a graph or starting a tf.Session.
+
+    It computes exactly the same quantity as SFMCore._init_main_block:
+    for each view the elementwise product of its mode embeddings
+    [X_m W[0][m], X_m W[v][m]] + Bias[v][m], projected on Phi[:, v] and
+    summed over the views.
+
+    Parameters
+    ----------
+    view_list: list of int tuple
+        # index starting from 1
+        modes in each view structure, see SFMCore.
+
+    W : list of {np.array, StoredTable}, shape: [n_views + 1][n_modes]
+        W[0][m] has shape [n_feature_list[m], co_rank], W[v][m] has shape
+        [n_feature_list[m], view_rank] or is None if view_rank == 0
+        or mode m is not used in view v.
+
+    Bias : list of np.array, shape: [n_views + 1][n_modes]
+        Bias[v][m] has shape [1, co_rank + view_rank] or is None if mode m
+        is not used in view v. Bias[0] is unused.
+
+    Phi : np.array, shape: [co_rank + view_rank, n_views]
+        Projection of the view products.
+
+    b : float, default: 0.0
+        Intercept, kept for completeness: as in SFMCore it is not added
+        to the outputs.
+
+    input_type : str, 'dense', 'sparse' or 'index', default: 'dense'
+        Both numpy.array and scipy.sparse.csr_matrix are accepted at scoring
+        time for 'dense' and 'sparse'. 'index' takes feature ids or
+        (ids, weights) bags, see SFMBaseModel.
+
+    hashers : list of {FeatureHasher, None} or None, default: None
+        Hashers of the modes trained with hash_buckets, applied to the raw
+        columns of the inputs (or of the mode matrices) before projection,
+        see SFMBaseModel.
+
+    Notes
+    -----
+    Each call of .decision_function() only holds the mode embeddings of a
+    single batch, so the memory footprint is bounded by batch_size.
+    """
+    def __init__(self, view_list, W, Bias, Phi, b=0.0, input_type='dense', hashers=None):
+        self.view_list = view_list
+        self.W = W
+        self.Bias = Bias
+        self.Phi = np.asarray(Phi)
+        self.b = b
+        self.input_type = input_type
+        self.hashers = hashers
+        self.n_modes = max([x for v in view_list for x in v])
+        self.n_views = len(view_list)
+        self.co_rank = W[0][0].shape[1]
+        self.view_rank = self.Phi.shape[0] - self.co_rank
+
+    def _project(self, X_m, v, m, mode_matrix=None):
+        """Compute X_m W[v][m], X_m being row indicators if mode_matrix is given."""
+        if mode_matrix is None and self.input_type == 'index':
+            if isinstance(X_m, tuple):
+                ids, weights = X_m
+                return (self.W[v][m][ids] * weights[:, :, np.newaxis]).sum(axis=1)
+            return self.W[v][m][X_m]
+        if mode_matrix is None:
+            return _dot(self._hash(X_m, m), self.W[v][m])
+        # project only the entities referenced in this batch
+        entities, inverse = np.unique(X_m, return_inverse=True)
+        return _dot(self._hash(mode_matrix[entities], m), self.W[v][m])[inverse]
+
+    def _hash(self, X_m, m):
+        if self.hashers is None or self.hashers[m] is None:
+            return X_m
+        return self.hashers[m].transform(X_m)
+
+    def mode_embedding(self, X_m, v, m, mode_matrix=None):
+        """Embedding of mode m (starting from 0) in view v (starting from 1).
+
+        Returns
+        -------
+        XW : np.array, shape (n_samples, co_rank + view_rank)
+        """
+        XW = self._project(X_m, 0, m, mode_matrix)
+        if self.view_rank > 0:
+            XW = np.hstack((XW, self._project(X_m, v, m, mode_matrix)))
+        return XW + self.Bias[v][m]
+
+    def _decision_batch(self, X, mode_matrices):
+        outputs = 0
+        for i, modes in enumerate(self.view_list):
+            v = i + 1
+            prod_embedding = None
+            for m in set(modes):
+                mode_matrix = None if mode_matrices is None else mode_matrices[m - 1]
+                XW = self.mode_embedding(X[m - 1], v, m - 1, mode_matrix)
+                if prod_embedding is None:
+                    prod_embedding = XW
+                else:
+                    prod_embedding *= XW
+            outputs = outputs + prod_embedding.dot(self.Phi[:, i])
+        return outputs
+
+    def decision_function(self, X, mode_matrices=None, batch_size=-1):
+        """Compute the raw SFM outputs.
+
+        Parameters
+        ----------
+        X : list of {numpy.array, scipy.sparse.csr_matrix, tuple}, shape: [n_modes]
+            Samples of each mode, or the row indicators of mode_matrices
+            in the relational case.
+
+        mode_matrices : list of {numpy.array, scipy.sparse.csr_matrix} or None
+            Mode matrices used in the relational case.
+
+        batch_size : int, default: -1
+            Number of samples scored at once. Use -1 for a single batch.
+
+        Returns
+        -------
+        pred_y : np.array, shape (n_samples,)
+        """
+        assert isinstance(X, list)
+        n_samples = n_rows(X[0])
+        output = []
+        for start, stop in batch_bounds(n_samples, batch_size):
+            bX = [take_rows(x, slice(start, stop)) for x in X]
+            output.append(self._decision_batch(bX, mode_matrices))
+        return np.concatenate(output).reshape(-1)
+
+    def freeze(self, mode_matrices=None):
+        """Precompute the embedding of every entity for fast relational scoring.
+
+        Parameters
+        ----------
+        mode_matrices : list of {numpy.array, scipy.sparse.csr_matrix} or None
+            Mode matrices of the relational case. None treats every mode as
+            one-hot encoded, i.e. entities are the features themselves
+            (the buckets for hashed modes).
+
+        Returns
+        -------
+        EntityScorer
+        """
+        tables = [[None] * self.n_modes for i in range(self.n_views + 1)]
+        for i, modes in enumerate(self.view_list):
+            v = i + 1
+            for m in set(modes):
+                if mode_matrices is None:
+                    XW = np.asarray(self.W[0][m - 1])
+                    if self.view_rank > 0:
+                        XW = np.hstack((XW, np.asarray(self.W[v][m - 1])))
+                    tables[v][m - 1] = XW + self.Bias[v][m - 1]
+                else:
+                    tables[v][m - 1] = self.mode_embedding(mode_matrices[m - 1], v, m - 1)
+        return EntityScorer(self.view_list, tables, self.Phi, self.b)
+
+
+class EntityScorer(object):
+    """
+    Scores tuples of entity indices from precomputed per-entity embeddings.
+
+    A prediction reduces to one gather per mode and view, an elementwise
+    product and a dot product with Phi. Usually obtained by SFMScorer.freeze().
+
+    Parameters
+    ----------
+    view_list: list of int tuple
+        # index starting from 1
+        modes in each view structure, see SFMCore.
+
+    tables : list of np.array, shape: [n_views + 1][n_modes]
+        tables[v][m] has shape [n_entities[m], co_rank + view_rank] and holds
+        mode_matrix[m] [W[0][m], W[v][m]] + Bias[v][m], or is None if mode m
+        is not used in view v. tables[0] is unused.
+
+    Phi : np.array, shape: [co_rank + view_rank, n_views]
+
+    b : float, default: 0.0
+        Intercept, not added to the outputs (see SFMScorer).
+    """
+    def __init__(self, view_list, tables, Phi, b=0.0):
+        self.view_list = view_list
+        self.tables = tables
+        self.Phi = np.asarray(Phi)
+        self.b = b
+
+    def _decision_batch(self, X):
+        outputs = 0
+        for i, modes in enumerate(self.view_list):
+            v = i + 1
+            prod_embedding = None
+            for m in set(modes):
+                XW = self.tables[v][m - 1][X[m - 1]]
+                if prod_embedding is None:
+                    prod_embedding = XW
+                else:
+                    prod_embedding *= XW
+            outputs = outputs + prod_embedding.dot(self.Phi[:, i])
+        return outputs
+
+    def decision_function(self, X, batch_size=-1):
+        """Compute the raw SFM outputs.
+
+        Parameters
+        ----------
+        X : list of np.array of int, shape: [n_modes]
+            Entity indices of each mode, i.e. row indicators of the mode matrices.
+
+        batch_size : int, default: -1
+            Number of samples scored at once. Use -1 for a single batch.
+
+        Returns
+        -------
+        pred_y : np.array, shape (n_samples,)
+        """
+        assert isinstance(X, list)
+        n_samples = X[0].shape[0]
+        output = []
+        for start, stop in batch_bounds(n_samples, batch_size):
+            bX = [x[start:stop] for x in X]
+            output.append(self._decision_batch(bX))
+        return np.concatenate(output).reshape(-1)
+
+
+def _kmeans(X, n_clusters, n_iter=10, block_size=65536, random_state=None):
+    """Lloyd's k-means on the rows of X, assignments computed by blocks.
+
+    Returns
+    -------
+    centers : np.array, shape (n_clusters, n_dims)
+    labels : np.array of int, shape (n_rows,)
+    """
+    rng = np.random.RandomState(random_state)
+    n_clusters = min(n_clusters, X.shape[0])
+    centers = X[rng.choice(X.shape[0], n_clusters, replace=False)].astype(np.float64)
+    labels = np.zeros(X.shape[0], dtype=np.int64)
+    for it in range(n_iter):
+        sq_centers = (centers ** 2).sum(axis=1)
+        for start, stop in batch_bounds(X.shape[0], block_size):
+            # ||x||^2 does not change the nearest center
+            labels[start:stop] = np.argmin(sq_centers - 2 * X[start:stop].dot(centers.T), axis=1)
+        counts = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, X)
+        non_empty = counts > 0
+        centers[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+    return centers, labels
+
+
+def _merge_top_k(scores, ids, k):
+    """Keep the k best columns of each row of scores, sorted by decreasing score."""
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    if scores.shape[1] > k:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, ids = scores[rows, best], ids[rows, best]
+    order = np.argsort(-scores, axis=1)
+    return scores[rows, order], ids[rows, order]
+
+
+class TopKRetriever(object):
+    """
+    Retrieves the best entities of a target mode for queries fixing the other modes.
+
+    For a view v containing the target mode t, the output is linear in the
+    embedding of the target entity: tables[v][t][item] . q_v with
+    q_v = Phi[:, v] * prod_{m != t} tables[v][m][X[m]]. The query vectors
+    of the selected views are concatenated and scored against the
+    concatenated item tables with blocked matrix products. Views without
+    the target mode add the same value to every item and are ignored.
+
+    Parameters
+    ----------
+    entity_scorer : EntityScorer
+        Precomputed per-entity embeddings, see SFMScorer.freeze().
+
+    target_mode : int
+        # index starting from 1
+        Mode of the retrieved entities.
+
+    views : list of int or None, default: None
+        # index starting from 1
+        Views used for ranking. None uses all the views containing
+        target_mode, which ranks items exactly as the full model does.
+
+    n_clusters : int or None, default: None
+        If given, build an approximate inverted-file index: the items are
+        clustered by k-means and a query only scores the items of the
+        n_probe clusters whose centers have the highest inner product.
+
+    n_probe : int, default: 8
+        Number of clusters searched per query by the approximate index.
+
+    random_state : int or None
+        Seed of the k-means initialization.
+    """
+    def __init__(self, entity_scorer, target_mode, views=None, n_clusters=None, n_probe=8,
+                 random_state=None):
+        self.entity_scorer = entity_scorer
+        self.target_mode = target_mode
+        if views is None:
+            views = [i + 1 for i, modes in enumerate(entity_scorer.view_list) if target_mode in modes]
+        for v in views:
+            if target_mode not in entity_scorer.view_list[v - 1]:
+                raise ValueError('Mode {} is not in view {}'.format(target_mode, v))
+        self.views = views
+        self.items = np.hstack([entity_scorer.tables[v][target_mode - 1] for v in views])
+        self.n_probe = n_probe
+        self.centers = None
+        if n_clusters is not None:
+            self.centers, labels = _kmeans(self.items, n_clusters, random_state=random_state)
+            order = np.argsort(labels, kind='mergesort')
+            self.cluster_items = np.split(order, np.cumsum(np.bincount(labels, minlength=len(self.centers)))[:-1])
+
+    def query_vectors(self, X):
+        """Query vectors of the tuples X.
+
+        Parameters
+        ----------
+        X : list of np.array of int, shape: [n_modes]
+            Entity indices of each mode; the entry of the target mode is ignored
+            and may be None.
+
+        Returns
+        -------
+        Q : np.array, shape (n_queries, len(views) * (co_rank + view_rank))
+        """
+        scorer = self.entity_scorer
+        n_queries = max(len(x) for m, x in enumerate(X) if x is not None and m != self.target_mode - 1)
+        queries = []
+        for v in self.views:
+            q = np.tile(scorer.Phi[:, v - 1], (n_queries, 1))
+            for m in set(scorer.view_list[v - 1]):
+                if m != self.target_mode:
+                    q = q * scorer.tables[v][m - 1][X[m - 1]]
+            queries.append(q)
+        return np.hstack(queries)
+
+    def top_k(self, X, k=100, query_batch_size=1024, item_block_size=65536):
+        """Best k entities of the target mode for every query.
+
+        Parameters
+        ----------
+        X : list of np.array of int, shape: [n_modes]
+            Queries, see query_vectors().
+
+        k : int, default: 100
+
+        query_batch_size, item_block_size : int
+            Sizes of the blocks of the score matrices computed at once.
+
+        Returns
+        -------
+        ids : np.array of int, shape (n_queries, k)
+            Entity indices of the target mode, by decreasing score. With
+            n_clusters, if the probed clusters hold fewer than k entities,
+            the remaining positions are padded with -1.
+
+        scores : np.array, shape (n_queries, k)
+            Contributions of the selected views, i.e. the outputs up to a
+            per-query constant, -inf at the padded positions.
+        """
+        k = min(k, self.items.shape[0])
+        Q = self.query_vectors(X)
+        all_ids, all_scores = [], []
+        for start, stop in batch_bounds(Q.shape[0], query_batch_size):
+            if self.centers is None:
+                scores, ids = self._exact(Q[start:stop], k, item_block_size)
+            else:
+                scores, ids = self._approximate(Q[start:stop], k)
+            all_ids.append(ids)
+            all_scores.append(scores)
+        return np.vstack(all_ids), np.vstack(all_scores)
+
+    def _exact(self, Q, k, item_block_size):
+        best_scores = np.empty((Q.shape[0], 0))
+        best_ids = np.empty((Q.shape[0], 0), dtype=np.int64)
+        for start, stop in batch_bounds(self.items.shape[0], item_block_size):
+            scores = Q.dot(self.items[start:stop].T)
+            ids = np.broadcast_to(np.arange(start, stop), scores.shape)
+            best_scores, best_ids = _merge_top_k(np.hstack((best_scores, scores)),
+                                                 np.hstack((best_ids, ids)), k)
+        return best_scores, best_ids
+
+    def _approximate(self, Q, k):
+        n_probe = min(self.n_probe, len(self.centers))
+        probes = np.argpartition(-Q.dot(self.centers.T), n_probe - 1, axis=1)[:, :n_probe]
+        best_scores = np.full((Q.shape[0], k), -np.inf)
+        best_ids = np.full((Q.shape[0], k), -1, dtype=np.int64)
+        for i in range(Q.shape[0]):
+            candidates = np.concatenate([self.cluster_items[c] for c in probes[i]])
+            scores = self.items[candidates].dot(Q[i])
+            n = min(k, len(candidates))
+            s, ids = _merge_top_k(scores[np.newaxis, :], candidates[np.newaxis, :], n)
+            best_scores[i, :n] = s[0]
+            best_ids[i, :n] = ids[0]
+        return best_scores, best_ids
@@ -10,6 +10,9 @@ from tqdm import tqdm
 
 from .core import SFMCore
 from .base import SFMBaseModel, loss_logistic, loss_mse
+from .als import fit_als
+from .data import NegativeSampler, NegativeSamplingDataset
+from .profiling import PhaseTimer
 
 
 
@@ -25,8 +28,11 @@ class SFMClassifier(SFMBaseModel):
     """
 
     def __init__(self, co_rank=10, view_rank = 0, isFullOrder=True, view_list=[[1]], input_type='dense', output_range=None, 
-                n_epochs=100, optimizer=tf.train.AdamOptimizer(learning_rate=0.1), reg_type='L2', reg=0.1,
-                batch_size=-1, init_std=0.01, init_scaling=2.0, log_dir=None, verbose=0,
+                n_epochs=100, optimizer=tf.train.AdamOptimizer(learning_rate=0.1), reg_type='L2', reg=0.1, lazy_reg=False,
+                batch_size=-1, resident_data=False, predict_batch_size=10000, shuffle='index',
+                prefetch=0, prefetch_threads=1, feature_headroom=0.0, hash_buckets=None, hash_sign=False,
+                init_std=0.01, init_scaling=2.0, log_dir=None, summary_steps=100,
+                step_callback=None, trace_steps=None, verbose=0,
                 session_config=None):
         init_params = {
             'co_rank': co_rank,
@@ -37,12 +43,24 @@ class SFMClassifier(SFMBaseModel):
             'output_range': output_range,
             'n_epochs': n_epochs,
             'batch_size': batch_size,
+            'resident_data': resident_data,
+            'predict_batch_size': predict_batch_size,
+            'shuffle': shuffle,
+            'prefetch': prefetch,
+            'prefetch_threads': prefetch_threads,
+            'feature_headroom': feature_headroom,
+            'hash_buckets': hash_buckets,
+            'hash_sign': hash_sign,
             'reg_type': reg_type,
             'reg': reg,
+            'lazy_reg': lazy_reg,
             'init_std': init_std, 
             'init_scaling': init_scaling,
             'optimizer': optimizer,
             'log_dir': log_dir,
+            'summary_steps': summary_steps,
+            'step_callback': step_callback,
+            'trace_steps': trace_steps,
             'loss_function': loss_logistic,
             'verbose': verbose
         }
@@ -53,6 +71,74 @@ class SFMClassifier(SFMBaseModel):
         assert(set(y_) == set([0, 1]))
         return y_ * 2 - 1
 
+    def preprocess_shard_target(self, y_):
+        # shards of sorted or click logs may hold a single class
+        assert(set(np.unique(y_)) <= set([0, 1]))
+        return y_ * 2 - 1
+
+    def fit_implicit(self, X_, mode_matrices=None, n_negatives=4, corrupt_modes=None,
+                     sampling='uniform', n_epochs=None, early_stop=None, show_progress=False,
+                     X_val=None, y_val=None, eval_every=1, patience=5):
+        """Fit the model on positive tuples only, sampling the negatives.
+
+        Every mini-batch of batch_size positives is completed by
+        n_negatives negatives per positive, drawn anew at every epoch
+        (see NegativeSampler), and trained with labels 1 and 0. With
+        lazy_reg, the feature frequencies include the expected negatives.
+
+        Parameters
+        ----------
+        X_ : list of np.array of int, shape: [n_modes]
+            Positive tuples: row indicators of mode_matrices in the
+            relational case, or ids with input_type='index'.
+
+        n_negatives : int, default: 4
+            Number of negatives per positive.
+
+        corrupt_modes : list of int or None
+            # index starting from 1
+            Modes replaced to form the negatives, each negative replacing
+            one of them. None for all the modes.
+
+        sampling : {'uniform', 'popularity'}, default: 'uniform'
+            Distribution of the replacing ids: uniform over the ids of the
+            mode, or proportional to their frequency among the positives
+            raised to the power 0.75.
+
+        X_val, y_val : held-out data or None
+            Labeled tuples (0/1 labels), see fit().
+
+        See fit() for the other parameters.
+
+        Returns
+        -------
+        used_epoch : int
+            Index of the last epoch run.
+        """
+        if mode_matrices is None and self.core.input_type != 'index':
+            raise ValueError('Negative sampling requires relational input or input_type=\'index\'')
+        self.fit_timing = PhaseTimer()
+        self._prepare_core(X_, mode_matrices)
+        with self.fit_timing.phase('prepare'):
+            if mode_matrices is not None:
+                n_ids_list = [mode_matrix.shape[0] for mode_matrix in mode_matrices]
+            else:
+                n_ids_list = list(self.core.n_feature_list)
+            counts = None
+            if sampling == 'popularity':
+                counts = [np.bincount(np.asarray(X_in_mode, dtype=np.int64), minlength=n_ids)
+                          for X_in_mode, n_ids in zip(X_, n_ids_list)]
+            sampler = NegativeSampler(n_ids_list, corrupt_modes, n_negatives, sampling, counts)
+            dataset = NegativeSamplingDataset(X_, sampler, self.preprocess_target(np.array([0, 1])),
+                                              input_type=self.core.input_type,
+                                              batch_size=self.batch_size,
+                                              isRelational=self.core.isRelational,
+                                              shuffle=self.shuffle)
+            self.set_reg_scales(dataset)
+
+        return self._train(lambda: [dataset], n_epochs, early_stop, show_progress,
+                           self._prepare_validation(X_val, y_val), eval_every, patience)
+
     def predict(self, X, mode_matrices = None):
         """Predict using the FM model
 
@@ -95,13 +181,29 @@ class SFMClassifier(SFMBaseModel):
 class SFMRegressor(SFMBaseModel):
     """Structural Factorization Machine (aka SFM).
 
-    This class implements SFM model with MSE loss and gradient-based optimization.
+    This class implements SFM model with MSE loss and gradient-based optimization
+    or alternating least squares.
 
-    See SFMBaseModel docs for details about parameters.
+    Parameters
+    ----------
+    solver : {'gd', 'als'}, default: 'gd'
+        'gd' trains with the optimizer by mini-batches. 'als' trains on the
+        whole training set by alternating least squares: each sweep solves
+        every factor column, the biases and Phi exactly (or by a few
+        conjugate gradient steps) given the other parameters, with NumPy and
+        SciPy, and fit() stops once the relative decrease of the target is
+        below 1e-5, usually after a few sweeps (n_epochs bounds the number of
+        sweeps). Requires reg_type='L2'; optimizer, batch_size and the
+        input pipeline settings are then unused.
+
+    See SFMBaseModel docs for details about other parameters.
     """
     def __init__(self, co_rank=10, view_rank = 0, isFullOrder=True, view_list=[[1]], input_type='dense', output_range = None,
-                n_epochs=100, optimizer=tf.train.AdamOptimizer(learning_rate=0.1), reg_type='L2', reg=0.1,
-                batch_size=-1, init_std=0.01, init_scaling=2.0, log_dir=None, verbose=0,
+                n_epochs=100, optimizer=tf.train.AdamOptimizer(learning_rate=0.1), solver='gd', reg_type='L2', reg=0.1, lazy_reg=False,
+                batch_size=-1, resident_data=False, predict_batch_size=10000, shuffle='index',
+                prefetch=0, prefetch_threads=1, feature_headroom=0.0, hash_buckets=None, hash_sign=False,
+                init_std=0.01, init_scaling=2.0, log_dir=None, summary_steps=100,
+                step_callback=None, trace_steps=None, verbose=0,
                 session_config=None):
         init_params = {
             'co_rank': co_rank,
@@ -112,20 +214,46 @@ class SFMRegressor(SFMBaseModel):
             'output_range': output_range,
             'n_epochs': n_epochs,
             'batch_size': batch_size,
+            'resident_data': resident_data,
+            'predict_batch_size': predict_batch_size,
+            'shuffle': shuffle,
+            'prefetch': prefetch,
+            'prefetch_threads': prefetch_threads,
+            'feature_headroom': feature_headroom,
+            'hash_buckets': hash_buckets,
+            'hash_sign': hash_sign,
             'reg_type': reg_type,
             'reg': reg,
+            'lazy_reg': lazy_reg,
             'init_std': init_std,
             'init_scaling': init_scaling,
             'optimizer': optimizer,
             'log_dir': log_dir,
+            'summary_steps': summary_steps,
+            'step_callback': step_callback,
+            'trace_steps': trace_steps,
             'loss_function': loss_mse,
             'verbose': verbose
         }
+        if solver not in ('gd', 'als'):
+            raise ValueError('Unknown solver {}, use \'gd\' or \'als\''.format(solver))
+        self.solver = solver
         self.init_basemodel(**init_params)
 
     def preprocess_target(self, y_):
         return y_
 
+    def fit(self, X_, y_, mode_matrices=None, n_epochs=None, early_stop=None, show_progress=False,
+            X_val=None, y_val=None, eval_every=1, patience=5):
+        """Fit the model, see SFMBaseModel.fit().
+
+        With solver='als', early_stop and the validation arguments are unused.
+        """
+        if self.solver == 'als':
+            return fit_als(self, X_, y_, mode_matrices, n_epochs, show_progress)
+        return super(SFMRegressor, self).fit(X_, y_, mode_matrices, n_epochs, early_stop, show_progress,
+                                             X_val, y_val, eval_every, patience)
+
     def predict(self, X, mode_matrices = None):
         """Predict using the SFM model
 
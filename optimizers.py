@@ -0,0 +1,54 @@
+"""
+    Optimizers with lazy sparse updates of the factor tables
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import tensorflow as tf
+
+
+class LazyAdamOptimizer(tf.train.AdamOptimizer):
+    """Adam updating only the rows present in sparse gradients.
+
+    For tf.IndexedSlices gradients (factor tables with 'sparse', 'index' or
+    relational sparse input), the moments and the values of the rows used
+    by the batch are read and written, instead of decaying the moments of
+    every row at every step as tf.train.AdamOptimizer does. The cost of a
+    step then scales with the number of features in the batch instead of
+    the number of rows of the tables.
+
+    The moments of a row are only decayed on the steps that use it, so the
+    updates of rare features differ from Adam's. Dense gradients are
+    handled by tf.train.AdamOptimizer unchanged: the gradients of the
+    tables are only sparse with lazy_reg=True or reg=0, since the penalty
+    over the full tables reaches every row.
+
+    Takes the parameters of tf.train.AdamOptimizer.
+    """
+    def _beta_powers(self):
+        if hasattr(self, '_get_beta_accumulators'):
+            return self._get_beta_accumulators()
+        return self._beta1_power, self._beta2_power
+
+    def _apply_sparse(self, grad, var):
+        # duplicate indices are summed beforehand by Optimizer.apply_gradients
+        dtype = var.dtype.base_dtype
+        beta1_power, beta2_power = [tf.cast(p, dtype) for p in self._beta_powers()]
+        lr_t = tf.cast(self._lr_t, dtype)
+        beta1_t = tf.cast(self._beta1_t, dtype)
+        beta2_t = tf.cast(self._beta2_t, dtype)
+        epsilon_t = tf.cast(self._epsilon_t, dtype)
+        lr = lr_t * tf.sqrt(1 - beta2_power) / (1 - beta1_power)
+        indices = grad.indices
+
+        m = self.get_slot(var, 'm')
+        m_t = tf.scatter_update(m, indices,
+                                beta1_t * tf.gather(m, indices) + (1 - beta1_t) * grad.values,
+                                use_locking=self._use_locking)
+        v = self.get_slot(var, 'v')
+        v_t = tf.scatter_update(v, indices,
+                                beta2_t * tf.gather(v, indices) + (1 - beta2_t) * tf.square(grad.values),
+                                use_locking=self._use_locking)
+        var_update = tf.scatter_sub(var, indices,
+                                    lr * tf.gather(m_t, indices) / (tf.sqrt(tf.gather(v_t, indices)) + epsilon_t),
+                                    use_locking=self._use_locking)
+        return tf.group(var_update, m_t, v_t)
@@ -0,0 +1,144 @@
+"""
+    Data-parallel training of Structural Factorization Machines on CPU cores
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import tensorflow as tf
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+
+from .core import SFMCore
+from .data import batch_bounds, prepare_mode_matrices
+
+
+def trainable_values(core, session):
+    """Values of the trainable variables of core, by variable name."""
+    variables = core.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
+    return dict(zip([var.op.name for var in variables], session.run(variables)))
+
+
+def load_trainable_values(core, session, values):
+    """Load values returned by trainable_values() into the variables of core."""
+    for var in core.graph.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES):
+        var.load(values[var.op.name], session)
+
+
+def average_values(all_values):
+    return dict((name, np.mean([values[name] for values in all_values], axis=0))
+                for name in all_values[0])
+
+
+class _Worker(object):
+    """Trains a core on its shard of a PreparedDataset, a few steps at a time."""
+    def __init__(self, core, session, dataset, rows, batch_size, shuffle):
+        self.core = core
+        self.session = session
+        self.dataset = dataset
+        self.rows = rows
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batches = iter([])
+
+    def start_epoch(self):
+        rows = self.rows
+        if len(rows) == 0:
+            self.batches = iter([])
+            return
+        if self.shuffle is not None:
+            rows = np.random.permutation(rows)
+        self.batches = iter([rows[start:stop] for start, stop in batch_bounds(len(rows), self.batch_size)])
+
+    def run(self, n_steps=None):
+        """Run up to n_steps (all remaining if None) steps of the epoch.
+
+        Returns
+        -------
+        steps : int
+        target_value : float, sum of the batch targets
+        """
+        steps, target_value = 0, 0.0
+        for rows in self.batches:
+            fd = self.dataset.feeddict(self.core, rows)
+            _, batch_target_value = self.session.run([self.core.trainer, self.core.target], feed_dict=fd)
+            target_value += batch_target_value
+            steps += 1
+            if n_steps is not None and steps >= n_steps:
+                break
+        return steps, target_value
+
+
+def _replica(model, mode_matrices):
+    """Independent graph and session with the same structure as model.core."""
+    core = SFMCore(**model.core_arguments)
+    core.set_relational_input(model.core.isRelational)
+    core.set_num_features(model.core.n_feature_list)
+    core.set_capacity(model.core.capacity_list)
+    core.set_bag_modes(model.core.bag_modes)
+    core.build_graph()
+    session = tf.Session(config=tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True)),
+                         graph=core.graph)
+    session.run(core.init_all_vars)
+    if mode_matrices is not None:
+        fd = {}
+        for m, prepared in enumerate(prepare_mode_matrices(mode_matrices, core.input_type, model.hashers)):
+            fd.update(zip(core.mode_matrix_inputs[m], prepared))
+        session.run(core.init_mode_matrices, feed_dict=fd)
+    if core.init_reg_scales is not None:
+        session.run(core.init_reg_scales, feed_dict=dict(zip(core.reg_scale_inputs, model.reg_scale_values)))
+    return core, session
+
+
+def fit_parallel(model, X_, y_, mode_matrices=None, n_workers=2, sync_period=None,
+                 n_epochs=None, show_progress=False):
+    """Data-parallel training of model, see SFMBaseModel.fit_parallel()."""
+    model._prepare_core(X_, mode_matrices)
+    if n_epochs is None:
+        n_epochs = model.n_epochs
+    model.entity_scorer = None
+    dataset = model._prepare_dataset(X_, y_)
+    shards = np.array_split(np.random.permutation(dataset.n_samples), n_workers)
+
+    replicas = []
+    if sync_period is None:
+        # Hogwild: every worker updates the shared variables without locking
+        workers = [_Worker(model.core, model.session, dataset, rows, model.batch_size, model.shuffle)
+                   for rows in shards]
+    else:
+        values = trainable_values(model.core, model.session)
+        for rows in shards:
+            core, session = _replica(model, mode_matrices)
+            load_trainable_values(core, session, values)
+            replicas.append((core, session))
+        workers = [_Worker(core, session, dataset, rows, model.batch_size, model.shuffle)
+                   for (core, session), rows in zip(replicas, shards)]
+
+    pool = ThreadPool(n_workers)
+    try:
+        for epoch in tqdm(range(n_epochs), unit='epoch', disable=(not show_progress)):
+            for worker in workers:
+                worker.start_epoch()
+            target_value, cc = 0.0, 0
+            while True:
+                results = pool.map(lambda worker: worker.run(sync_period), workers)
+                steps = sum(r[0] for r in results)
+                if steps == 0:
+                    break
+                cc += steps
+                target_value += sum(r[1] for r in results)
+                if sync_period is None:
+                    break
+                # model averaging
+                values = average_values([trainable_values(core, session) for core, session in replicas])
+                for core, session in replicas:
+                    load_trainable_values(core, session, values)
+            model.steps += cc
+            if model.verbose > 1:
+                print(target_value / max(cc, 1))
+        if replicas:
+            load_trainable_values(model.core, model.session, values)
+    finally:
+        pool.terminate()
+        for core, session in replicas:
+            session.close()
+    return n_epochs - 1
@@ -0,0 +1,86 @@
+"""
+    Wall-time accounting of the phases of training and prediction
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class PhaseTimer(object):
+    """Accumulates wall time and number of calls per named phase.
+
+    Thread-safe, so phases can also be timed from prefetching threads.
+
+    Attributes
+    ----------
+    totals : dict, phase -> float
+        Total seconds spent in each phase.
+
+    counts : dict, phase -> int
+        Number of times each phase was entered.
+    """
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.totals[name] += seconds
+            self.counts[name] += 1
+
+    def snapshot(self):
+        """Copy of the totals.
+
+        Subtracting an earlier snapshot from a later one gives the seconds
+        spent in each phase in between.
+        """
+        with self._lock:
+            return dict(self.totals)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def timed(self, name, function):
+        """Wrap function so that its calls are accounted to phase name."""
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def iterate(self, name, iterable):
+        """Yield from iterable, accounting the time spent in each next() to phase name."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.time() - start)
+            yield item
+
+    def report(self):
+        """Summary of the phases.
+
+        Returns
+        -------
+        report : dict, phase -> {'total': seconds, 'count': int, 'mean': seconds}
+        """
+        with self._lock:
+            return dict((name, {'total': total,
+                                'count': self.counts[name],
+                                'mean': total / max(self.counts[name], 1)})
+                        for name, total in self.totals.items())
+
+    def __repr__(self):
+        return '\n'.join('{:<12} {:10.4f}s {:8d} calls'.format(name, stats['total'], stats['count'])
+                         for name, stats in sorted(self.report().items()))
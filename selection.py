@@ -0,0 +1,88 @@
+"""
+    Model selection utilities: training several configurations in one pass over the data
+"""
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+from multiprocessing.pool import ThreadPool
+from tqdm import tqdm
+
+
+def _placeholder_mapping(target_core, fd):
+    """Map the placeholders used in fd to those of target_core with the same names."""
+    return dict((placeholder, target_core.graph.get_tensor_by_name(placeholder.name))
+                for placeholder in fd)
+
+
+def fit_many(models, X_, y_, mode_matrices=None, n_epochs=None, show_progress=False, n_threads=None):
+    """Fit several estimators on the same data with a single input pipeline.
+
+    The mini-batches are shuffled, sliced and converted once per step and
+    consumed by every model, instead of once per model. The models may differ
+    in any parameter that does not change the input pipeline (e.g. reg,
+    co_rank, view_rank, init_scaling, optimizer); they must share the class,
+    input_type, feature hashing and number of modes. The batching parameters
+    (batch_size, shuffle, prefetch) and n_epochs of the first model are used
+    for all.
+
+    Parameters
+    ----------
+    models : list of SFMBaseModel
+
+    X_, y_, mode_matrices :
+        Training data, see SFMBaseModel.fit().
+
+    n_epochs : int or None
+        Defaults to models[0].n_epochs.
+
+    n_threads : int or None
+        Number of threads running the training steps of the models
+        concurrently. Defaults to len(models).
+
+    Returns
+    -------
+    models : list of SFMBaseModel
+        The fitted models.
+
+    Raises
+    ------
+    ValueError
+        If the models differ in number of modes or input_type.
+    """
+    first = models[0]
+    for model in models[1:]:
+        if model.core.n_modes != first.core.n_modes:
+            raise ValueError('All the models must have the same number of modes, got {} and {}'.format(
+                first.core.n_modes, model.core.n_modes))
+        if model.core.input_type != first.core.input_type:
+            raise ValueError('All the models must have the same input_type, got {} and {}'.format(
+                first.core.input_type, model.core.input_type))
+        assert type(model) is type(first)
+        assert model.hash_buckets == first.hash_buckets and model.hash_sign == first.hash_sign
+    if n_epochs is None:
+        n_epochs = first.n_epochs
+    for model in models:
+        model._prepare_core(X_, mode_matrices)
+        model.entity_scorer = None
+    dataset = first._prepare_dataset(X_, y_)
+    for model in models[1:]:
+        model.set_reg_scales(dataset)
+
+    mappings = None
+    pool = ThreadPool(n_threads or len(models))
+
+    def train_step(args):
+        model, mapping, fd = args
+        fd = dict((mapping[placeholder], value) for placeholder, value in fd.items())
+        _, target_value = model.session.run([model.core.trainer, model.core.target], feed_dict=fd)
+        model.steps += 1
+        return target_value
+
+    try:
+        for epoch in tqdm(range(n_epochs), unit='epoch', disable=(not show_progress)):
+            for fd in dataset.feeddicts(first.core, first.prefetch, first.prefetch_threads):
+                if mappings is None:
+                    mappings = [_placeholder_mapping(model.core, fd) for model in models]
+                pool.map(train_step, [(model, mapping, fd) for model, mapping in zip(models, mappings)])
+    finally:
+        pool.terminate()
+    return models
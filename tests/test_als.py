@@ -0,0 +1,115 @@
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+from ..als import ALSState, ModeDesign, design_matrices, _ridge_update
+from ..inference import SFMScorer
+
+
+def _random_params(rng, n_feature_list, view_list, co_rank, view_rank):
+    n_modes = len(n_feature_list)
+    r = co_rank + view_rank
+    W = [[rng.randn(n, co_rank) * 0.3 for n in n_feature_list]]
+    W += [[rng.randn(n, view_rank) * 0.3 if view_rank > 0 and m + 1 in modes else None
+           for m, n in enumerate(n_feature_list)] for modes in view_list]
+    Bias = [[None] * n_modes] + [[np.zeros((1, r)) if m + 1 in modes else None
+                                  for m in range(n_modes)] for modes in view_list]
+    return {'W': W, 'Bias': Bias, 'Phi': rng.randn(r, len(view_list)) * 0.3, 'b': 0.0}
+
+
+def _inputs(rng, input_type, n_samples, n_feature_list):
+    if input_type == 'dense':
+        return [rng.randn(n_samples, n) for n in n_feature_list], None
+    if input_type == 'sparse':
+        return [sp.random(n_samples, n, density=0.2, format='csr', random_state=rng)
+                for n in n_feature_list], None
+    if input_type == 'index':
+        return [rng.randint(0, n, size=n_samples) for n in n_feature_list], None
+    mode_matrices = [sp.random(20, n, density=0.3, format='csr', random_state=rng)
+                     for n in n_feature_list]
+    return [rng.randint(0, 20, size=n_samples) for n in n_feature_list], mode_matrices
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('relational', [False, True])
+def test_ridge_update_matches_direct_solve(sparse, relational):
+    rng = np.random.RandomState(0)
+    matrix = rng.randn(30, 8)
+    rows = rng.randint(0, 30, size=100) if relational else None
+    if sparse:
+        matrix = sp.csr_matrix(matrix * (rng.rand(30, 8) < 0.4))
+    X = ModeDesign(matrix, rows)
+    dense_X = np.asarray(matrix.todense() if sparse else matrix)
+    if relational:
+        dense_X = dense_X[rows]
+    n = dense_X.shape[0]
+    q, e, w, lam = rng.randn(n), rng.randn(n), rng.randn(8), 0.7
+
+    d, Xd = _ridge_update(X, q, e, w, lam, n_iter=50)
+
+    A = q[:, np.newaxis] * dense_X
+    expected = np.linalg.solve(A.T.dot(A) + lam * np.eye(8), A.T.dot(e) - lam * w)
+    np.testing.assert_allclose(d, expected, atol=1e-8)
+    np.testing.assert_allclose(Xd, dense_X.dot(d), atol=1e-8)
+
+
+def test_ridge_update_exact_in_one_step_for_one_hot():
+    rng = np.random.RandomState(1)
+    ids = rng.randint(0, 6, size=50)
+    X = design_matrices([ids], [6], 'index')[0]
+    q, e, w = rng.randn(50), rng.randn(50), rng.randn(6)
+    d, _ = _ridge_update(X, q, e, w, 0.5, n_iter=1)
+    A = q[:, np.newaxis] * np.eye(6)[ids]
+    expected = np.linalg.solve(A.T.dot(A) + 0.5 * np.eye(6), A.T.dot(e) - 0.5 * w)
+    np.testing.assert_allclose(d, expected, atol=1e-10)
+
+
+def test_relational_design_is_not_expanded():
+    rng = np.random.RandomState(2)
+    mode_matrix = rng.randn(10, 4)
+    ids = rng.randint(0, 10, size=1000)
+    X = design_matrices([ids], [4], 'dense', [mode_matrix])[0]
+    assert X.matrix.shape == (10, 4)
+    np.testing.assert_allclose(X.dot(np.eye(4)), mode_matrix[ids])
+    v = rng.randn(1000)
+    np.testing.assert_allclose(X.rdot(v), mode_matrix[ids].T.dot(v))
+
+
+@pytest.mark.parametrize('input_type', ['dense', 'sparse', 'index', 'relational'])
+@pytest.mark.parametrize('isFullOrder', [False, True])
+def test_sweeps_decrease_target_and_match_scorer(input_type, isFullOrder):
+    rng = np.random.RandomState(3)
+    n_feature_list, view_list = [15, 10, 8], [(1, 2), (1, 2, 3), (2, 3)]
+    X, mode_matrices = _inputs(rng, input_type, 300, n_feature_list)
+    scorer_input_type = 'sparse' if input_type == 'relational' else input_type
+    truth = _random_params(rng, n_feature_list, view_list, 3, 2)
+    y = SFMScorer(view_list, truth['W'], truth['Bias'], truth['Phi'],
+                  input_type=scorer_input_type).decision_function(X, mode_matrices)
+    y += 0.1 * rng.randn(len(y))
+
+    design = design_matrices(X, n_feature_list, scorer_input_type, mode_matrices)
+    state = ALSState(view_list, design, y, _random_params(rng, n_feature_list, view_list, 3, 2),
+                     0.01, isFullOrder)
+    targets = [state.target()]
+    for sweep in range(8):
+        targets.append(state.sweep())
+    assert np.all(np.diff(targets) <= 1e-12)
+    assert targets[-1] < targets[0]
+
+    outputs = SFMScorer(view_list, state.W, state.Bias, state.Phi,
+                        input_type=scorer_input_type).decision_function(X, mode_matrices)
+    np.testing.assert_allclose(y - outputs, state.e, atol=1e-10)
+
+
+def test_sweeps_without_regularization():
+    rng = np.random.RandomState(4)
+    X = [rng.randn(20, 3), np.zeros((20, 2))]
+    params = _random_params(rng, [3, 2], [(1,)], 2, 0)
+    state = ALSState([(1,)], design_matrices(X, [3, 2], 'dense'), np.zeros(20), params, 0.0, True)
+    with np.errstate(all='raise'):
+        for sweep in range(3):
+            assert state.sweep() < 1e-20
+    # mode 2 is in no view, its table only carries the penalty
+    assert not state.W[0][1].any()
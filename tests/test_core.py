@@ -0,0 +1,27 @@
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+
+def test_gather_csr_rows_matches_scipy():
+    from ..core import gather_csr_rows
+    rng = np.random.RandomState(0)
+    X = sp.random(20, 7, density=0.2, format='csr', random_state=rng, dtype=np.float32)
+    # empty rows first, last, repeated and consecutive
+    kept = np.ones((20, 1), dtype=np.float32)
+    kept[[0, 5, 6, 19]] = 0
+    X = sp.csr_matrix(X.multiply(kept))
+    rows = np.array([0, 3, 5, 6, 3, 19, 1, 2, 0, 19], dtype=np.int64)
+
+    with tf.Graph().as_default(), tf.Session() as session:
+        segment_ids, columns, data = session.run(gather_csr_rows(
+            tf.constant(X.indptr.astype(np.int64)), tf.constant(X.indices.astype(np.int64)),
+            tf.constant(X.data), tf.constant(rows)))
+
+    gathered = sp.csr_matrix((data, (segment_ids, columns)), shape=(len(rows), X.shape[1]))
+    np.testing.assert_array_equal(gathered.toarray(), X[rows].toarray())
+    assert len(data) == X[rows].nnz
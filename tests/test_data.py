@@ -0,0 +1,110 @@
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+from ..data import (FeatureHasher, SparseMode, PreparedDataset, NegativeSampler,
+                   NegativeSamplingDataset, reg_scales)
+
+
+def _to_csr(triple):
+    indices, values, shape = triple
+    return sp.csr_matrix((values, (indices[:, 0], indices[:, 1])), shape=tuple(shape))
+
+
+def _hashed(X, hasher):
+    """Reference hashing, one stored element at a time."""
+    X = sp.coo_matrix(X)
+    X_hashed = np.zeros((X.shape[0], hasher.n_buckets))
+    for i, j, x in zip(X.row, X.col, X.data):
+        h = int(hasher._hash(np.array([j]))[0])
+        X_hashed[i, h % hasher.n_buckets] += -x if hasher.signed and h >> 63 else x
+    return X_hashed
+
+
+@pytest.mark.parametrize('signed', [False, True])
+def test_feature_hasher_transform(signed):
+    rng = np.random.RandomState(0)
+    X = sp.random(30, 1000, density=0.05, format='csr', random_state=rng)
+    original = X.copy()
+    hasher = FeatureHasher(16, signed, seed=3)
+    X_hashed = hasher.transform(X)
+    assert X_hashed.shape == (30, 16)
+    np.testing.assert_allclose(X_hashed.toarray(), _hashed(X, hasher), rtol=1e-6, atol=1e-6)
+    # the input is left untouched and hashing is deterministic
+    for name in ('indptr', 'indices', 'data'):
+        np.testing.assert_array_equal(getattr(X, name), getattr(original, name))
+    np.testing.assert_array_equal(FeatureHasher(16, signed, seed=3).transform(X).toarray(),
+                                  X_hashed.toarray())
+
+
+@pytest.mark.parametrize('block_size', [None, 1, 4, 7])
+@pytest.mark.parametrize('hashed', [False, True])
+def test_sparse_mode_slice_and_take(block_size, hashed):
+    rng = np.random.RandomState(1)
+    X = sp.random(25, 40, density=0.15, format='csr', random_state=rng, dtype=np.float32)
+    hasher = FeatureHasher(8, signed=True) if hashed else None
+    expected = _hashed(X, hasher) if hashed else X.toarray()
+    mode = SparseMode(X, block_size, hasher)
+
+    for start, stop in [(0, 25), (0, 4), (4, 8), (3, 11), (7, 14), (21, 25), (5, 5)]:
+        np.testing.assert_allclose(_to_csr(mode.slice(start, stop)).toarray(),
+                                   expected[start:stop], rtol=1e-6)
+    for rows in [np.array([3, 0, 24, 3, 10]), np.arange(25)[::-1], np.array([], dtype=np.int64)]:
+        np.testing.assert_allclose(_to_csr(mode.take(rows)).toarray(), expected[rows], rtol=1e-6)
+
+
+def _lazy_penalty(ids, scales, norms, epoch_size):
+    """Penalty of an epoch fed as one batch, as SFMCore with lazy_reg."""
+    return (scales[ids] * norms[ids]).sum() / epoch_size
+
+
+def test_reg_scales_match_full_penalty():
+    rng = np.random.RandomState(0)
+    X = sp.random(200, 30, density=0.1, format='csr', random_state=rng)
+    dataset = PreparedDataset([X], input_type='sparse')
+    counts = dataset.feature_counts(0, 40)
+    np.testing.assert_array_equal(counts[:30], np.diff(X.tocsc().indptr))
+    assert not counts[30:].any()
+
+    scales = reg_scales(counts, dataset.epoch_size)
+    norms = rng.rand(40)
+    ids = dataset.modes[0].indices[:, 1]
+    np.testing.assert_allclose(_lazy_penalty(ids, scales, norms, dataset.epoch_size),
+                               norms[counts > 0].sum(), rtol=1e-6)
+    assert not scales[counts == 0].any()
+
+
+def test_reg_scales_unbiased_under_negative_sampling():
+    rng = np.random.RandomState(1)
+    np.random.seed(1)
+    n_ids_list = [50, 40]
+    positives = [rng.randint(0, n, size=300) for n in n_ids_list]
+    for sampling in ('uniform', 'popularity'):
+        counts = [np.bincount(x, minlength=n) for x, n in zip(positives, n_ids_list)]
+        sampler = NegativeSampler(n_ids_list, n_negatives=3, sampling=sampling, counts=counts)
+        dataset = NegativeSamplingDataset(positives, sampler, [0.0, 1.0])
+        for m, n in enumerate(n_ids_list):
+            expected = dataset.feature_counts(m, n)
+            np.testing.assert_allclose(expected.sum(), dataset.epoch_size)
+
+            n_epochs = 200
+            empirical = sum(np.bincount(sampler.sample(positives)[0][m], minlength=n)
+                            for epoch in range(n_epochs)) / n_epochs
+            np.testing.assert_allclose(empirical, expected, rtol=0.1, atol=1.0)
+
+            # the mean lazy penalty over the epochs is the full penalty
+            scales = reg_scales(expected, dataset.epoch_size)
+            norms = rng.rand(n)
+            np.testing.assert_allclose(empirical.dot(scales * norms) / dataset.epoch_size,
+                                       norms[expected > 0].sum(), rtol=0.02)
+
+
+def test_expected_counts_of_modes_not_corrupted():
+    sampler = NegativeSampler([5, 5], corrupt_modes=[1], n_negatives=2)
+    counts = np.array([3, 0, 1, 0, 0, 0])
+    # the negatives copy the ids of mode 2 of their positive
+    np.testing.assert_allclose(sampler.expected_counts(1, counts), 3 * counts)
+    np.testing.assert_allclose(sampler.expected_counts(0, counts),
+                               counts + 2 * 4 * np.array([0.2] * 5 + [0]))
@@ -0,0 +1,77 @@
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import numpy as np
+import scipy.sparse as sp
+import pytest
+
+from ..export import quantize, save_model, load_model, read_config
+from ..inference import SFMScorer, StoredTable
+
+
+def _params(rng, n_feature_list, view_list, rank):
+    n_modes = len(n_feature_list)
+    W = [[rng.randn(n, rank) for n in n_feature_list]] + [[None] * n_modes for modes in view_list]
+    Bias = [[None] * n_modes] + [[rng.randn(1, rank) if m + 1 in modes else None
+                                  for m in range(n_modes)] for modes in view_list]
+    return {'W': W, 'Bias': Bias, 'Phi': rng.randn(rank, len(view_list)), 'b': 0.5}
+
+
+def test_quantize_round_trip():
+    rng = np.random.RandomState(0)
+    W = rng.randn(100, 5).astype(np.float32)
+    W[:, 2] = 0
+
+    values, scales = quantize(W, 'float32')
+    assert scales is None
+    np.testing.assert_array_equal(values, W)
+
+    values, scales = quantize(W, 'float16')
+    assert values.dtype == np.float16 and scales is None
+    np.testing.assert_allclose(values.astype(np.float32), W, rtol=1e-3, atol=1e-4)
+
+    values, scales = quantize(W, 'int8')
+    assert values.dtype == np.int8 and scales.dtype == np.float32
+    np.testing.assert_allclose(scales, np.where(W.any(axis=0), np.abs(W).max(axis=0) / 127, 1),
+                               rtol=1e-6)
+    assert np.all(np.abs(StoredTable(values, scales)[:] - W) <= scales / 2 * (1 + 1e-5))
+    assert not values[:, 2].any()
+
+    with pytest.raises(ValueError):
+        quantize(W, 'int4')
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'int8'])
+@pytest.mark.parametrize('mmap', [True, False])
+def test_load_model_matches_scorer(tmpdir, dtype, mmap):
+    rng = np.random.RandomState(1)
+    view_list = [(1, 2), (2, 3)]
+    params = _params(rng, [20, 15, 10], view_list, 4)
+    path = str(tmpdir.join('model.sfm'))
+    save_model(path, params, view_list, dtype, config={'input_type': 'sparse'})
+    assert read_config(path) == {'input_type': 'sparse'}
+
+    X = [sp.random(50, n, density=0.2, format='csr', random_state=rng) for n in [20, 15, 10]]
+    expected = SFMScorer(view_list, params['W'], params['Bias'], params['Phi'], params['b'],
+                         input_type='sparse').decision_function(X)
+    scores = load_model(path, mmap=mmap).decision_function(X)
+    tolerance = {'float32': 1e-5, 'float16': 1e-2, 'int8': 5e-2}[dtype]
+    np.testing.assert_allclose(scores, expected, rtol=tolerance, atol=tolerance * np.abs(expected).max())
+
+
+def test_load_model_hashes_as_in_training(tmpdir):
+    rng = np.random.RandomState(2)
+    view_list = [(1, 2)]
+    params = _params(rng, [8, 6], view_list, 3)
+    path = str(tmpdir.join('model.sfm'))
+    save_model(path, params, view_list,
+               config={'input_type': 'sparse', 'hash_buckets': [8, None], 'hash_sign': True})
+    scorer = load_model(path)
+    assert scorer.hashers[0].n_buckets == 8 and scorer.hashers[0].signed
+    assert scorer.hashers[1] is None
+
+    # raw ids of mode 1 far beyond the number of buckets
+    X = [sp.random(40, 10000, density=0.001, format='csr', random_state=rng),
+         sp.random(40, 6, density=0.3, format='csr', random_state=rng)]
+    expected = SFMScorer(view_list, params['W'], params['Bias'], params['Phi'], params['b'],
+                         input_type='sparse').decision_function([scorer.hashers[0].transform(X[0]), X[1]])
+    np.testing.assert_allclose(scorer.decision_function(X), expected, rtol=1e-5, atol=1e-5)
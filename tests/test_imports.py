@@ -0,0 +1,32 @@
+from __future__ import (absolute_import, division,
+                                print_function, unicode_literals)
+import os
+import subprocess
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = __name__.split('.')[0]
+
+
+def _run_without_tensorflow(statements):
+    code = '; '.join(["import sys", "sys.modules['tensorflow'] = None"] + statements)
+    subprocess.check_call([sys.executable, '-c', code.format(PACKAGE)],
+                          cwd=os.path.dirname(PACKAGE_DIR))
+
+
+def test_inference_without_tensorflow():
+    _run_without_tensorflow(["import {0}.inference",
+                             "from {0} import SFMScorer",
+                             "assert not hasattr(sys.modules['{0}'], 'SFMRegressor')"])
+
+
+def test_load_model_without_tensorflow(tmpdir):
+    path = str(tmpdir.join('model.sfmx'))
+    _run_without_tensorflow([
+        "import numpy as np",
+        "from {0}.export import save_model, load_model",
+        "W = [[np.ones((3, 2)), np.ones((4, 2))], [None, None]]",
+        "Bias = [[None, None], [np.zeros((1, 2)), np.zeros((1, 2))]]",
+        "save_model(%r, dict(W=W, Bias=Bias, Phi=np.ones((2, 1)), b=0.0), [(1, 2)])" % path,
+        "scores = load_model(%r).decision_function([np.eye(3), np.eye(4)[:3]])" % path,
+        "assert np.allclose(scores, 2.0)"])